@@ -0,0 +1,205 @@
+#!/usr/bin/env python2.7
+"""
+Time pb-git against a synthetic multi-repo tree.
+
+Scenarios:
+    checkout_cold         empty workspace
+    checkout_warm         nothing changed (the journal should skip everything)
+    checkout_warm_force   nothing changed, but --force
+    checkout_one_changed  one remote has a new commit in its ini
+    verify_fast           every SHA1 is on a remote-tracking branch
+    verify_slow           no remote-tracking branches, so the slow way
+    prepare               one repo moved ahead of its ini, with a stand-in p4
+
+Results are written as JSON. Compare with an earlier result to catch
+regressions:
+    bench/bench.py --output new.json --compare old.json
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+thisdir = os.path.dirname(os.path.abspath(__file__))
+topdir = os.path.dirname(thisdir)
+sys.path.insert(0, os.path.join(topdir, 'test'))
+import fixtures
+
+PB_GIT = os.path.join(topdir, 'pb-git')
+
+def pb_git(tree, env, args):
+    cmd = [sys.executable, PB_GIT, '-v', '0', '-d', tree['workspace']] + args
+    proc = subprocess.Popen(cmd, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    if proc.returncode:
+        raise Exception('{} -> {}\n{}'.format(' '.join(cmd), proc.returncode, err))
+
+def timed(func):
+    start = time.time()
+    func()
+    return time.time() - start
+
+def remove_repos(tree):
+    for cfg in tree['repos'].values():
+        path = os.path.join(tree['workspace'], cfg['path'])
+        if os.path.exists(path):
+            shutil.rmtree(path)
+
+def drop_remote_tracking(tree):
+    for cfg in tree['repos'].values():
+        path = os.path.join(tree['workspace'], cfg['path'])
+        refs = fixtures.git(['for-each-ref', '--format=%(refname)', 'refs/remotes'], cwd=path).split()
+        for ref in refs:
+            fixtures.git(['update-ref', '-d', ref], cwd=path)
+
+def forget_verified(env):
+    """So that 'verify' does not just hit the cache of earlier scenarios
+    (or, for the slow way, the scratch repos which it fetched into).
+    """
+    state = env['PB_GIT_STATE_DIR']
+    if os.path.exists(os.path.join(state, 'verified')):
+        os.remove(os.path.join(state, 'verified'))
+    if os.path.exists(os.path.join(state, 'verify')):
+        shutil.rmtree(os.path.join(state, 'verify'))
+
+def fetch_all(tree):
+    for cfg in tree['repos'].values():
+        fixtures.git(['fetch', '-q', 'origin'], cwd=os.path.join(tree['workspace'], cfg['path']))
+
+def move_one_ahead(tree):
+    """Move one repo HEAD ahead of its ini, as a developer would before 'prepare'.
+    """
+    name = sorted(tree['repos'])[0]
+    cfg = tree['repos'][name]
+    sha1 = fixtures.add_commits(cfg['url'], 1, seed=99)
+    path = os.path.join(tree['workspace'], cfg['path'])
+    fixtures.git(['fetch', '-q', 'origin'], cwd=path)
+    fixtures.git(['checkout', '-q', sha1], cwd=path)
+
+def run_scenarios(tree, env, opts):
+    """Return dict(scenario: list of seconds).
+    """
+    results = dict()
+    checkout = ['checkout', '--jobs', str(opts.jobs), '--mirrors', tree['mirrors']]
+    def add(name, setup, args):
+        times = list()
+        for _ in range(opts.repeat):
+            setup()
+            times.append(timed(lambda: pb_git(tree, env, args)))
+        results[name] = times
+        sys.stderr.write('{:22} {}\n'.format(name, ' '.join('{:.3f}'.format(t) for t in times)))
+    nothing = lambda: None
+    add('checkout_cold', lambda: remove_repos(tree), checkout)
+    add('checkout_warm', nothing, checkout)
+    add('checkout_warm_force', nothing, checkout + ['--force'])
+    bumped = dict(n=0)
+    def bump_one():
+        bumped['n'] += 1
+        name = sorted(tree['repos'])[bumped['n'] % len(tree['repos'])]
+        fixtures.bump(tree, name)
+        if tree['mirrors']:
+            fixtures.sync_mirror(tree, name)
+    add('checkout_one_changed', bump_one, checkout)
+    verify = ['verify', '--jobs', str(opts.jobs)]
+    add('verify_fast', lambda: forget_verified(env), verify)
+    def setup_verify_slow():
+        forget_verified(env)
+        drop_remote_tracking(tree)
+    add('verify_slow', setup_verify_slow, verify)
+    fetch_all(tree) # Restore remote-tracking branches.
+    def setup_prepare():
+        # Undo the last 'prepare', then move one repo ahead again.
+        for name, cfg in tree['repos'].items():
+            fixtures.write_ini(os.path.join(tree['workspace'], name + '.ini'), cfg)
+        move_one_ahead(tree)
+    add('prepare', setup_prepare, ['prepare', '--jobs', str(opts.jobs)])
+    return results
+
+def summarize(times):
+    times = sorted(times)
+    return dict(seconds=times, min=times[0], median=times[len(times)//2])
+
+def compare(new, old, threshold):
+    """Return list of regression messages.
+    """
+    regressions = list()
+    for name, res in sorted(new['results'].items()):
+        if name not in old['results']:
+            continue
+        before, after = old['results'][name]['median'], res['median']
+        ratio = after / before if before else float('inf')
+        line = '{:22} {:8.3f}s -> {:8.3f}s  x{:.2f}'.format(name, before, after, ratio)
+        if ratio > threshold:
+            line += '  REGRESSION'
+            regressions.append(line)
+        sys.stderr.write(line + '\n')
+    return regressions
+
+def get_meta(opts):
+    def capture(cmd):
+        try:
+            return subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()[0].strip()
+        except OSError:
+            return None
+    return dict(
+        time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+        commit=capture(['git', '-C', topdir, 'rev-parse', 'HEAD']),
+        git=capture(['git', '--version']),
+        python=platform.python_version(),
+        host=platform.node(),
+        params=dict(repos=opts.repos, files=opts.files, file_size=opts.file_size,
+            commits=opts.commits, mirror=opts.mirror, jobs=opts.jobs, repeat=opts.repeat),
+    )
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repos', type=int, default=20, help='Number of repos.')
+    parser.add_argument('--files', type=int, default=50, help='Files per repo.')
+    parser.add_argument('--file-size', type=int, default=4000, help='Bytes per file.')
+    parser.add_argument('--commits', type=int, default=50, help='History depth of each repo.')
+    parser.add_argument('--mirror', action='store_true', help='Also build a local directory-style mirror, and check out through it.')
+    parser.add_argument('--jobs', type=int, default=4, help='Passed to pb-git.')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per scenario.')
+    parser.add_argument('--workdir', help='Where to generate the tree. (Default: a new tempdir, removed afterwards.)')
+    parser.add_argument('--output', help='Write results here, as JSON.')
+    parser.add_argument('--compare', help='Earlier results (JSON) to compare against.')
+    parser.add_argument('--threshold', type=float, default=1.25, help='Median slowdown ratio which counts as a regression.')
+    opts = parser.parse_args(argv[1:])
+
+    workdir = opts.workdir or tempfile.mkdtemp(prefix='pb-git-bench.')
+    try:
+        sys.stderr.write('Generating {} repos in {}\n'.format(opts.repos, workdir))
+        tree = fixtures.make_tree(workdir, opts.repos, opts.files, opts.file_size, opts.commits, opts.mirror)
+        bindir = os.path.join(workdir, 'bin')
+        fixtures.make_p4_stub(bindir)
+        env = dict(os.environ,
+                PATH=bindir + os.pathsep + os.environ.get('PATH', ''),
+                PYTHONPATH=topdir,
+                PB_GIT_STATE_DIR=os.path.join(workdir, 'state'),
+                PB_GIT_DEFAULT_MIRRORS_BASE='',
+                **fixtures.GIT_ENV)
+        results = run_scenarios(tree, env, opts)
+    finally:
+        if not opts.workdir:
+            shutil.rmtree(workdir)
+    report = dict(meta=get_meta(opts),
+            results=dict((name, summarize(times)) for name, times in results.items()))
+    if opts.output:
+        with open(opts.output, 'w') as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    if opts.compare:
+        with open(opts.compare) as fp:
+            regressions = compare(report, json.load(fp), opts.threshold)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,262 @@
+"""
+Shared cache of bare repos (branches and tags), one per normalized origin URL.
+
+New clones borrow objects from the cache via 'git clone --reference',
+so they write little more than a working tree. Each entry remembers
+which workspaces borrow from it. Before an entry is evicted, those
+workspaces are dissociated (repacked with their own copy of the objects),
+so eviction never breaks a checkout.
+"""
+from __future__ import absolute_import
+from . import cmds
+from . import locks
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+import time
+
+
+log = cmds.log
+
+CACHE_DIR_ENV = 'PB_GIT_CACHE_DIR'
+CACHE_SIZE_ENV = 'PB_GIT_CACHE_SIZE'
+CACHE_SIZE_DEFAULT = '20G'
+META = 'pb-git-cache.json'
+# A borrower registered before its clone finished protects the entry this long.
+PENDING_TTL = 24 * 60 * 60
+# Only branches and tags. ('clone --mirror' would also take e.g. GitHub's refs/pull/*.)
+REFSPECS = "'+refs/heads/*:refs/heads/*' '+refs/tags/*:refs/tags/*'"
+
+def parse_size(size):
+    """Return number of bytes.
+    >>> parse_size('1024')
+    1024
+    >>> parse_size('2k')
+    2048
+    >>> parse_size('1.5G')
+    1610612736
+    """
+    mo = re.match(r'^\s*([\d.]+)\s*([kKmMgGtT]?)[bB]?\s*$', str(size))
+    if not mo:
+        raise ValueError('Bad size {!r}'.format(size))
+    num, unit = mo.groups()
+    power = ' KMGT'.index(unit.upper() or ' ')
+    return int(float(num) * 1024**power)
+
+def normalize_url(url):
+    """Different spellings of one repo should share an entry.
+    >>> normalize_url('git@github.com:PacBio/Foo.git')
+    'github.com/PacBio/Foo'
+    >>> normalize_url('https://GitHub.com/PacBio/Foo/')
+    'github.com/PacBio/Foo'
+    >>> normalize_url('ssh://git@bitbucket.nanofluidics.com:7999/sat/bam2fastx.git')
+    'bitbucket.nanofluidics.com:7999/sat/bam2fastx'
+    >>> normalize_url('file:///tmp/foo.git')
+    '/tmp/foo'
+    """
+    url = url.strip().rstrip('/')
+    if url.endswith('.git'):
+        url = url[:-4]
+    mo = re.match(r'^(?P<scheme>[a-z+]+)://(?:[^@/]*@)?(?P<rest>.*)$', url)
+    if mo:
+        rest = mo.group('rest')
+    else:
+        mo = re.match(r'^(?:[^@/]*@)?(?P<host>[^:/]+):(?P<path>.*)$', url)
+        if mo:
+            # scp-like syntax
+            rest = '{}/{}'.format(mo.group('host'), mo.group('path'))
+        else:
+            return os.path.abspath(url)
+    if rest.startswith('/'):
+        return rest # file://
+    host, _, path = rest.partition('/')
+    return '{}/{}'.format(host.lower(), path)
+
+def url_key(url):
+    """Content-address for a URL.
+    """
+    return hashlib.sha1(normalize_url(url)).hexdigest()
+
+def is_cacheable(url):
+    """Plain local paths are already cloned with hardlinks.
+    """
+    return ':' in url
+
+def get_entry(cache_dir, url):
+    return os.path.join(os.path.abspath(cache_dir), url_key(url) + '.git')
+
+def read_meta(entry):
+    try:
+        with open(os.path.join(entry, META)) as fp:
+            return json.load(fp)
+    except (IOError, ValueError):
+        return dict(url=None, last_used=0, borrowers=list(), pending=dict())
+
+def write_meta(entry, meta):
+    fn = os.path.join(entry, META)
+    tmp = '{}.{}.tmp'.format(fn, os.getpid())
+    with open(tmp, 'w') as fp:
+        json.dump(meta, fp, indent=2, sort_keys=True)
+    os.rename(tmp, fn)
+
+def fetch(gitdir, source):
+    cmds.capture('git --git-dir={} fetch --quiet --prune {} {}'.format(gitdir, source, REFSPECS))
+
+def ensure(cache_dir, url, sha1, borrower=None, source=None):
+    """Create or update the cache entry for url (the origin), so that it has sha1.
+    Fetch from source (default: url), e.g. a mirror of the origin, which
+    shares the entry.
+    Register borrower (a gitdir about to be cloned with --reference) as pending,
+    so that prune() will not evict the entry during the clone.
+    Return the path to the bare repo.
+    """
+    entry = get_entry(cache_dir, url)
+    source = source or url
+    with locks.get_lock(entry):
+        if not os.path.isdir(entry):
+            cmds.mkdirs(os.path.dirname(entry))
+            tmp = '{}.{}.tmp'.format(entry, os.getpid())
+            if os.path.exists(tmp):
+                shutil.rmtree(tmp)
+            cmds.capture('git init --quiet --bare {}'.format(tmp))
+            fetch(tmp, source)
+            os.rename(tmp, entry)
+        elif not cmds.has_commit(entry, sha1):
+            fetch(entry, source)
+        meta = read_meta(entry)
+        meta['url'] = url
+        meta['last_used'] = time.time()
+        if borrower:
+            meta.setdefault('pending', dict())[os.path.abspath(borrower)] = meta['last_used']
+        write_meta(entry, meta)
+    return entry
+
+def add_borrower(entry, gitdir):
+    """Record that gitdir borrows objects from entry.
+    """
+    gitdir = os.path.abspath(gitdir)
+    with locks.get_lock(entry):
+        meta = read_meta(entry)
+        pending = meta.setdefault('pending', dict()).pop(gitdir, None)
+        if pending or gitdir not in meta['borrowers']:
+            if gitdir not in meta['borrowers']:
+                meta['borrowers'].append(gitdir)
+            write_meta(entry, meta)
+
+def get_alternates_fn(gitdir):
+    return os.path.join(gitdir, 'objects', 'info', 'alternates')
+
+def borrows(gitdir, entry):
+    """Does gitdir still list entry in its alternates?
+    """
+    objects = os.path.join(entry, 'objects')
+    try:
+        with open(get_alternates_fn(gitdir)) as fp:
+            lines = fp.read().split()
+    except IOError:
+        return False
+    return any(os.path.realpath(line) == os.path.realpath(objects) for line in lines)
+
+def dissociate(gitdir, entry):
+    """Copy borrowed objects into gitdir, then stop borrowing from entry.
+    (This is what 'git clone --dissociate' does.)
+    """
+    log.warning('Dissociating "{}" from cache entry "{}".'.format(gitdir, entry))
+    cmds.capture('git --git-dir={} repack -a -d -q'.format(gitdir))
+    objects = os.path.realpath(os.path.join(entry, 'objects'))
+    fn = get_alternates_fn(gitdir)
+    with open(fn) as fp:
+        lines = [line for line in fp.read().split() if os.path.realpath(line) != objects]
+    if lines:
+        with open(fn, 'w') as fp:
+            fp.write('\n'.join(lines) + '\n')
+    else:
+        os.remove(fn)
+
+def du(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for fn in files:
+            try:
+                total += os.lstat(os.path.join(root, fn)).st_size
+            except OSError:
+                pass
+    return total
+
+def list_entries(cache_dir):
+    """Return list of dict(entry, url, size, last_used, borrowers),
+    least-recently used first. Only live borrowers are listed.
+    """
+    if not os.path.isdir(cache_dir):
+        return list()
+    entries = list()
+    for name in os.listdir(cache_dir):
+        entry = os.path.join(os.path.abspath(cache_dir), name)
+        if not name.endswith('.git') or not os.path.isdir(entry):
+            continue
+        meta = read_meta(entry)
+        borrowers = [b for b in meta['borrowers'] if borrows(b, entry)]
+        entries.append(dict(entry=entry, url=meta['url'], size=du(entry),
+            last_used=meta['last_used'], borrowers=borrowers))
+    entries.sort(key=lambda e: e['last_used'])
+    return entries
+
+def evict(entry):
+    """Return False if a clone is still borrowing (pending).
+    Borrowers are re-read under the lock, which ensure() and add_borrower() also take.
+    """
+    with locks.get_lock(entry):
+        meta = read_meta(entry)
+        now = time.time()
+        pending = [b for b, t in meta.get('pending', dict()).iteritems() if now - t < PENDING_TTL]
+        if pending:
+            log.info('Not evicting cache entry "{}", which {} may be cloning from.'.format(entry, pending))
+            return False
+        for gitdir in meta['borrowers']:
+            if borrows(gitdir, entry):
+                dissociate(gitdir, entry)
+        log.log(cmds.info_mod, 'Evicting cache entry "{}".'.format(entry))
+        shutil.rmtree(entry)
+    return True
+
+def prune(cache_dir, max_size):
+    """Evict least-recently used entries until the cache fits in max_size bytes.
+    Return list of evicted entries.
+    """
+    entries = list_entries(cache_dir)
+    total = sum(e['size'] for e in entries)
+    evicted = list()
+    for e in entries:
+        if total <= max_size:
+            break
+        if evict(e['entry']):
+            total -= e['size']
+            evicted.append(e)
+    return evicted
+
+def format_entries(entries):
+    lines = list()
+    for e in entries:
+        lines.append('{:>10} {} {:2} {} {}'.format(
+            e['size'],
+            time.strftime('%Y-%m-%d %H:%M', time.localtime(e['last_used'])),
+            len(e['borrowers']),
+            os.path.basename(e['entry']),
+            e['url']))
+    lines.append('{:>10} total in {} entries'.format(sum(e['size'] for e in entries), len(entries)))
+    return '\n'.join(lines) + '\n'
+
+def manage(args):
+    """Show the cache, and prune it if asked.
+    """
+    cmds.init(args)
+    if not args.cache:
+        raise Exception('No cache directory. Use --cache or {}.'.format(CACHE_DIR_ENV))
+    if args.prune:
+        max_size = parse_size(args.cache_size)
+        for e in prune(args.cache, max_size):
+            log.warning('Evicted {} ({} bytes)'.format(e['url'], e['size']))
+    sys.stdout.write(format_entries(list_entries(args.cache)))
@@ -6,19 +6,27 @@ update in p4.
 """
 from __future__ import absolute_import
 from contextlib import contextmanager
+import argparse
+import atexit
+import collections
 import ConfigParser as configparser
+import errno
 import functools
 import glob
+import hashlib
+import json
 import logging
 import os
 import re
-import shlex
 import shutil
 import StringIO
 import subprocess
 import sys
-import tempfile
+import threading
+import time
 import traceback
+from . import refs
+from . import trace
 
 log = logging.getLogger(__name__)
 info_mod = logging.INFO+2
@@ -28,28 +36,60 @@ log_info_sys = functools.partial(log.log, info_sys)
 log_info_mod = functools.partial(log.log, info_mod)
 debug_sys = logging.DEBUG+1
 log_debug_sys = functools.partial(log.log, debug_sys)
-cd_depth = 0
+# Per-thread state: cd() depth, worker CWD, held log records.
+_tls = threading.local()
+_main_thread = threading.current_thread()
+_log_lock = threading.RLock()
+
+def getcwd():
+    """Like os.getcwd(), but aware of cd() within a worker thread.
+    """
+    dirs = getattr(_tls, 'dirs', None)
+    if dirs:
+        return dirs[-1]
+    return os.getcwd()
 
 @contextmanager
 def cd(newdir, cleanup=lambda: True):
-    global cd_depth
-    prevdir = os.getcwd()
-    log.info("[{}]cd '{}' from '{}'".format(cd_depth, newdir, prevdir))
-    os.chdir(os.path.expanduser(newdir))
-    cd_depth += 1
+    """Only the main thread actually changes the process CWD.
+    In a worker thread, the new dir is remembered per-thread,
+    and capture()/system() run their subprocesses there.
+    """
+    depth = getattr(_tls, 'depth', 0)
+    prevdir = getcwd()
+    newdir = os.path.normpath(os.path.join(prevdir, os.path.expanduser(newdir)))
+    log.info("[{}]cd '{}' from '{}'".format(depth, newdir, prevdir))
+    in_main = threading.current_thread() is _main_thread
+    if in_main:
+        os.chdir(newdir)
+    else:
+        _tls.dirs = getattr(_tls, 'dirs', []) + [newdir]
+    _tls.depth = depth + 1
     try:
         yield
     finally:
-        cd_depth -= 1
-        log.info("[{}]cd '{}' back from '{}'".format(cd_depth, prevdir, newdir))
-        os.chdir(prevdir)
+        _tls.depth = depth
+        log.info("[{}]cd '{}' back from '{}'".format(depth, prevdir, newdir))
+        if in_main:
+            os.chdir(prevdir)
+        else:
+            _tls.dirs = _tls.dirs[:-1]
         cleanup()
 
 def system(call, checked=True):
     """Raise IOError on failure if checked.
+    Inside log_grouped(), the output is logged instead of
+    going straight to the terminal.
     """
     log.log(info_sys, call)
-    rc = os.system(call)
+    if getattr(_tls, 'held', None) is None:
+        returncode, out, _ = trace.run(call, shell=True, stdout=None, stderr=None, cwd=getcwd())
+    else:
+        returncode, out, _ = trace.run(call, shell=True, stderr=subprocess.STDOUT, cwd=getcwd())
+        if out.strip():
+            # On failure, this is the only place the error text goes, so it must be visible.
+            log.log(logging.ERROR if returncode and checked else info_sys, out.rstrip())
+    rc = trace.wait_status(returncode)
     if rc and checked:
         raise IOError('{rc} <- {call!r}'.format(rc=rc, call=call))
     return rc
@@ -64,22 +104,155 @@ def capture(call, log=log_info_sys):
     # so we should trap that too. Why does anybody like p4?
     badvars = set(["P4DIFF", "P4MERGE"])
     env = dict((k, v) for k, v in os.environ.iteritems() if k not in badvars)
-    proc = subprocess.Popen(shlex.split(call),
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            env=env
-            )
-    out, err = proc.communicate()
+    returncode, out, err = trace.run(call, env=env, cwd=getcwd())
     if out: log('{}'.format(out.rstrip()))
-    if proc.returncode:
+    if returncode:
         #log.debug(out)
         raise IOError(err)
     return out, err
 
+class GroupingHandler(logging.Handler):
+    """Wrap another handler. Within log_grouped(), hold the records
+    of the current thread, so that the output of concurrent workers
+    is not interleaved.
+    """
+    def __init__(self, target):
+        logging.Handler.__init__(self)
+        self.target = target
+    def emit(self, record):
+        held = getattr(_tls, 'held', None)
+        if held is not None:
+            held.append((self.target, record))
+        else:
+            with _log_lock:
+                self.target.handle(record)
+
+@contextmanager
+def log_grouped():
+    """Emit all log records of this thread together, at the end.
+    """
+    _tls.held = list()
+    try:
+        yield
+    finally:
+        held = _tls.held
+        _tls.held = None
+        with _log_lock:
+            for hdlr, record in held:
+                hdlr.handle(record)
+
+def parallel_map(func, items, jobs=1):
+    """Return [func(item) for item in items], using up to 'jobs' threads.
+    The log output of each call is grouped.
+    If any call fails, re-raise the first failure, but only after
+    all calls have finished.
+    """
+    items = list(items)
+    if jobs <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    from multiprocessing.pool import ThreadPool # slow to import
+    def call(item):
+        with log_grouped():
+            try:
+                return True, func(item)
+            except Exception:
+                log.debug('Failure in worker thread.', exc_info=True)
+                return False, sys.exc_info()
+    pool = ThreadPool(min(jobs, len(items)))
+    try:
+        # A timeout lets KeyboardInterrupt through in python2.
+        outcomes = pool.map_async(call, items, chunksize=1).get(60*60*24*7)
+    finally:
+        pool.close()
+        pool.join()
+    failures = [result for ok, result in outcomes if not ok]
+    for exc_info in failures[1:]:
+        log.error('Also failed: {!r}'.format(exc_info[1]))
+    if failures:
+        exc_type, exc_value, tb = failures[0]
+        raise exc_type, exc_value, tb
+    return [result for ok, result in outcomes]
+
 def rename(old, new):
     log.log(info_sys, 'Moving "{}" to "{}"'.format(old, new))
     os.rename(old, new)
 
+def add_cache_arguments(p):
+    from . import cache
+    p.add_argument('--cache',
+            default=os.environ.get(cache.CACHE_DIR_ENV, ''),
+            help='Shared object cache directory. Clones borrow objects from here. \'\' => no cache. [default can be over-ridden via {}]'.format(cache.CACHE_DIR_ENV),
+            )
+    p.add_argument('--cache-size',
+            default=os.environ.get(cache.CACHE_SIZE_ENV, cache.CACHE_SIZE_DEFAULT),
+            help='Size budget for --cache, e.g. 500M or 20G. Least-recently used entries are evicted beyond this. [default can be over-ridden via {}]'.format(cache.CACHE_SIZE_ENV),
+            )
+
+def add_worktree_arguments(p):
+    from . import worktree
+    p.add_argument('--worktrees',
+            default=os.environ.get(worktree.WORKTREE_DIR_ENV, ''),
+            help='Keep one central bare repo per URL here, and check out each repo as a `git worktree` of it, so workspaces on this host share objects. \'\' => ordinary clones. [default can be over-ridden via {}]'.format(worktree.WORKTREE_DIR_ENV),
+            )
+
+def add_checkout_arguments(p):
+    """The options of 'checkout', which 'migrate' also runs.
+    """
+    from . import mirrors
+    p.add_argument('--mirrors',
+            default=None,
+            help='Clone/fetch from the mirror first, while it is healthy (see `remotes`). Use this path, plus ext/pi etc. if a directory (relative to --directory). \'\' => no mirror. [default is {!r}, and can be over-ridden via {}]'.format(
+                mirrors.PB_GIT_DEFAULT_MIRRORS_BASE_DEFAULT, mirrors.MIRRORS_BASE_ENV),
+            )
+    p.add_argument('--manifest',
+            default='git-manifest.json',
+            help='Dump a file to show what we checked out. By default, this will go into the --directory. (Deprecated. Probably not used anymore, but not sure.)',
+            )
+    p.add_argument('--csv',
+            default='git-manifest.csv',
+            help='Dump a file to show what we checked out. By default, this will go into the --directory. (csv for easy parsing by bash.)',
+            )
+    p.add_argument('-j', '--jobs',
+            default=1, type=int,
+            help='Check out this many repos concurrently. The log output of each repo is kept together.',
+            )
+    p.add_argument('--journal',
+            default='.pb-git-state.json',
+            help='Remember the state of each repo after checkout, so that unchanged repos can be skipped next time without running git. By default, this will go into the --directory.',
+            )
+    p.add_argument('--force',
+            action='store_true',
+            help='Ignore the --journal, and check every repo.',
+            )
+    p.add_argument('--fetch',
+            choices=['all', 'sha1'], default='all',
+            help='When a SHA1 is missing, fetch everything from the remote, or only that SHA1 (falling back on everything if the server refuses). A module config may set "fetch" itself.',
+            )
+    p.add_argument('--depth',
+            type=int,
+            help='Clone (and fetch) with this history depth. A module config may set "depth" itself.',
+            )
+    p.add_argument('--filter',
+            help='Partial clone, e.g. "blob:none". A module config may set "filter" itself, or "sparse" (directories, for a cone-mode sparse checkout, with "blob:none" by default).',
+            )
+    p.add_argument('--race',
+            action='store_true',
+            help='For a fresh clone, clone from the mirror and the origin at once, keep the first to finish, and cancel the other. (Otherwise, the remote with the better record goes first; see `remotes`.)',
+            )
+    p.add_argument('--maintain',
+            action='store_true',
+            help='Afterwards, run the cheap mode of `maintain` on repos past its thresholds.',
+            )
+    add_cache_arguments(p)
+    add_worktree_arguments(p)
+
+def get_checkout_defaults():
+    """Return dict of the defaults of add_checkout_arguments().
+    """
+    parser = argparse.ArgumentParser()
+    add_checkout_arguments(parser)
+    return vars(parser.parse_args([]))
+
 def init_argparse(parser):
     """Add our basic arguments for an ArgumentParser.
     """
@@ -92,6 +265,8 @@ def init_argparse(parser):
     parser.add_argument('-v', '--verbosity',
             default=1, type=int,
             help='0=>only errors/warnings; 1=>modifications; 2=>syscalls; 3=>info; 4=>debug')
+    parser.add_argument('--trace',
+            help='Record every subprocess (time, exit code, output size, repo, phase) into this file, as JSON in Chrome trace-event format.')
 
 def init(args):
     fmt = '[%(levelname)s] %(message)s'
@@ -111,17 +286,38 @@ def init(args):
     hdlr = logging.StreamHandler(sys.stderr)
     hdlr.setFormatter(fmtr)
     root = logging.getLogger()
-    root.addHandler(hdlr)
+    root.addHandler(GroupingHandler(hdlr))
     root.setLevel(lvl)
 
     global VERBOSITY
     VERBOSITY = args.verbosity
 
+    global _trace_registered
+    if not _trace_registered:
+        # Summarize even when a command fails.
+        trace_fn = getattr(args, 'trace', None)
+        atexit.register(trace.finish, trace_fn and os.path.abspath(trace_fn), info_mod)
+        _trace_registered = True
+_trace_registered = False
+VERBOSITY = 1
+
+
+def get_state_dir():
+    """Where we remember things between runs, per user.
+    """
+    return os.environ.get('PB_GIT_STATE_DIR',
+            os.path.join(os.path.expanduser('~'), '.cache', 'pb-git'))
 
 def mkdirs(d):
+    """Like 'mkdir -p'. Another thread or process may be creating d (or a parent) too.
+    """
     if not os.path.isdir(d):
         log.log(info_sys, 'mkdir -p {}'.format(d))
-        os.makedirs(d)
+        try:
+            os.makedirs(d)
+        except OSError as e:
+            if e.errno != errno.EEXIST or not os.path.isdir(d):
+                raise
 
 def write_repo_config(fp, cfg, section='general'):
     """Write dict 'cfg' into section of ConfigParser file.
@@ -149,6 +345,66 @@ def read_module(fn):
     log.debug("{!r} -> {!r}".format(fn, cfg))
     return cfg
 
+INI_INDEX = '.pb-git-ini-index.json'
+
+# abspath: dict(mtime, size, cfg), shared by every command in this process.
+_ini_index = dict()
+_ini_index_lock = threading.Lock()
+
+def encode_strs(obj):
+    """For json.load(object_hook=...), so that a cfg from the index has the
+    same str types as one from ConfigParser.
+    >>> encode_strs({u'path': u'foo', u'size': 3})
+    {'path': 'foo', 'size': 3}
+    """
+    def encode(val):
+        return val.encode('utf-8') if isinstance(val, unicode) else val
+    return dict((encode(k), encode(v)) for k, v in obj.iteritems())
+
+def read_ini_index(index_fn):
+    try:
+        with open(index_fn) as fp:
+            return json.load(fp, object_hook=encode_strs)['files']
+    except Exception:
+        log.debug('No usable ini index {!r}.'.format(index_fn), exc_info=True)
+        return dict()
+
+def write_ini_index(index_fn, files):
+    try:
+        tmp = '{}.{}.tmp'.format(index_fn, os.getpid())
+        with open(tmp, 'w') as fp:
+            json.dump(dict(files=files), fp, indent=1, sort_keys=True)
+        os.rename(tmp, index_fn)
+    except Exception:
+        log.debug('Cannot write ini index {!r}.'.format(index_fn), exc_info=True)
+
+def index_modules(fns, index_fn=INI_INDEX):
+    """Return dict(fn: cfg), with a fresh copy of each cfg.
+    Only ini files whose (mtime, size) changed since the index was
+    written are parsed again.
+    """
+    with _ini_index_lock:
+        if not _ini_index:
+            _ini_index.update(read_ini_index(index_fn))
+        now = time.time()
+        changed = False
+        cfgs = dict()
+        for fn in fns:
+            key = os.path.abspath(fn)
+            st = os.stat(fn)
+            entry = _ini_index.get(key)
+            if not entry or entry['mtime'] != st.st_mtime or entry['size'] != st.st_size:
+                entry = dict(mtime=st.st_mtime, size=st.st_size, cfg=read_module(fn))
+                # Like git's "racily clean" check: a file written within the
+                # mtime granularity of now could change again unnoticed.
+                if now - st.st_mtime > 2:
+                    _ini_index[key] = entry
+                    changed = True
+            cfgs[fn] = dict(entry['cfg'])
+        if changed:
+            write_ini_index(index_fn, _ini_index)
+    return cfgs
+
 def read_modules(args):
     """Read all .ini, based on command-line args.
     Return dict(name: config).
@@ -159,9 +415,10 @@ def read_modules(args):
     else:
         log.log(info_basic, '--inis={}'.format(args.inis))
         fns = open(args.inis).read().strip().split()
+    cfgs = index_modules(fns)
     for fn in fns:
         log.log(info_basic, 'Processing "{}"'.format(fn))
-        cfg = read_module(fn)
+        cfg = cfgs[fn]
         name = os.path.basename(os.path.splitext(fn)[0])
         repos[name] = cfg
     return repos
@@ -174,12 +431,157 @@ def set_remote(url, remote, path):
     # In case the url is wrong, update it.
     capture('git -C {} remote set-url {} {}'.format(path, remote, url), log=log.debug)
 
-def checkout_repo_from_url(url, sha1, remote, path, mylog=log_info_sys):
+def get_reference(url, sha1, path, opts, source=None):
+    """Return the shared cache entry to borrow objects from, or None.
+    The entry is for url (the origin), even when we clone from source (a mirror).
+    The clone at path is registered as a borrower first.
+    """
+    cache_dir = opts.get('cache_dir')
+    if not cache_dir:
+        return None
+    from . import cache
+    source = source or url
+    if not cache.is_cacheable(source):
+        return None
+    try:
+        return cache.ensure(cache_dir, url, sha1, os.path.join(getcwd(), path, '.git'), source)
+    except Exception:
+        log.debug('Cache failure.', exc_info=True)
+        log.warning('Failed to update cache for "{}" in "{}". Cloning without it.'.format(url, cache_dir))
+        return None
+
+# Checkout options which a module config (ini) may set for itself.
+REPO_OPTS = ('fetch', 'depth', 'filter', 'sparse')
+
+def get_repo_opts(conf, opts):
+    """Settings in the module config override the command-line.
+    >>> sorted(get_repo_opts(dict(path='x', depth='1'), dict(depth=None, fetch='sha1')).items())
+    [('depth', '1'), ('fetch', 'sha1')]
+    """
+    opts = dict(opts or dict())
+    for key in REPO_OPTS:
+        if conf.get(key):
+            opts[key] = conf[key]
+    return opts
+
+def get_clone_options(opts):
+    """
+    >>> get_clone_options(dict(depth='1', filter='blob:none'))
+    ' --depth 1 --no-single-branch --filter=blob:none'
+    >>> get_clone_options(dict())
+    ''
+    >>> get_clone_options(dict(sparse='src'))
+    ' --filter=blob:none --no-checkout'
+    """
+    options = ''
+    if opts.get('depth'):
+        # All branch tips, so remote-tracking branches still work for 'verify'.
+        options += ' --depth {} --no-single-branch'.format(opts['depth'])
+    # With a sparse checkout, we need only the blobs we check out.
+    # (A server which does not support filters ignores this.)
+    filter = opts.get('filter') or ('blob:none' if opts.get('sparse') else None)
+    if filter:
+        options += ' --filter={}'.format(filter)
+    if opts.get('sparse'):
+        # Check out only after the sparse-checkout is set up.
+        options += ' --no-checkout'
+    return options
+
+def get_sparse_paths(cfg):
+    """The "sparse" key lists directories, separated by spaces, commas or lines.
+    >>> get_sparse_paths(dict(sparse='src/a, docs\\n tools/'))
+    ['docs', 'src/a', 'tools']
+    >>> get_sparse_paths(dict())
+    []
+    """
+    return sorted(p.strip('/') for p in re.split(r'[\s,]+', cfg.get('sparse') or '') if p.strip('/'))
+
+def get_sparse_state(path):
+    """Return the sorted directories of a cone-mode sparse checkout at path,
+    or None if it is not sparse.
+    """
+    gitdir = refs.find_git_dir(os.path.join(getcwd(), path))
+    if not gitdir or not os.path.exists(os.path.join(gitdir, 'info', 'sparse-checkout')):
+        return None
+    try:
+        out, _ = capture('git -C {} config --bool core.sparseCheckout'.format(path), log=log_debug_sys)
+    except IOError:
+        return None
+    if out.strip() != 'true':
+        return None
+    out, _ = capture('git -C {} sparse-checkout list'.format(path), log=log_debug_sys)
+    return sorted(out.split())
+
+def is_sparse_as_wanted(path, opts):
+    return get_sparse_state(path) == (get_sparse_paths(opts) or None)
+
+def apply_sparse(path, opts):
+    """Set up a cone-mode sparse checkout of opts['sparse'] (before
+    checking out), or drop one which is no longer wanted.
+    """
+    if is_sparse_as_wanted(path, opts):
+        return
+    paths = get_sparse_paths(opts)
+    if paths:
+        capture('git -C {} sparse-checkout set --cone {}'.format(path, ' '.join(paths)), log=log_info_sys)
+    else:
+        capture('git -C {} sparse-checkout disable'.format(path), log=log_info_sys)
+
+def is_shallow(path):
+    gitdir = refs.find_git_dir(os.path.join(getcwd(), path))
+    return bool(gitdir) and os.path.exists(os.path.join(refs.find_common_dir(gitdir), 'shallow'))
+
+def fetch_sha1(path, remote, sha1, opts):
+    """Fetch at least sha1 from remote.
+    With opts['fetch'] == 'sha1', ask for only that commit, but fall back
+    on a full fetch if the server refuses.
+    """
+    depth = ' --depth {}'.format(opts['depth']) if opts.get('depth') else ''
+    # capture(), so a failure carries git's message (see remotes.is_transport_error).
+    if opts.get('fetch') == 'sha1':
+        try:
+            capture('git -C {} fetch{} {} {}'.format(path, depth, remote, sha1))
+            return
+        except IOError:
+            log.warning('Remote "{}" refused to send {} alone. Fetching everything.'.format(remote, sha1))
+    capture('git -C {} fetch{} {}'.format(path, depth, remote))
+
+def seed_clone(seed, url, remote, path):
+    """Create the repo at path from the local object store 'seed'
+    (e.g. an old .git/modules/NAME), with no network.
+    Only what the seed had fetched from its origin becomes our
+    remote-tracking branches, so local work there cannot pass 'verify'.
+    A missing SHA1 is fetched later, as usual.
+    """
+    log_info_mod('Seeding {!r} from {!r}'.format(path, seed))
+    capture('git init --quiet {}'.format(path), log=log_debug_sys)
+    set_remote(url, remote, path)
+    capture("git -C {} fetch --quiet --no-tags {} '+refs/remotes/origin/*:refs/remotes/{}/*' '+refs/tags/*:refs/tags/*'".format(
+        path, os.path.join(getcwd(), seed), remote), log=log_info_sys)
+
+def checkout_repo_from_url(url, sha1, remote, path, mylog=log_info_sys, opts=None, origin_url=None):
     """Probably from GitHub.
+    opts: dict of checkout options, e.g. 'cache_dir', 'fetch', 'depth', 'filter'.
+    origin_url: if url is a mirror, the origin's (which names the cache entry).
+    Return True if we had to clone or fetch.
     """
+    opts = opts or dict()
     modified = False
+    seed = opts.get('seeds', dict()).get(path)
+    if seed and not os.path.exists(os.path.join(path, '.git', 'config')):
+        try:
+            seed_clone(seed, url, remote, path)
+            modified = True
+        except Exception:
+            log.debug('Cannot seed.', exc_info=True)
+            log.warning('Failed to seed "{}" from "{}". Cloning instead.'.format(path, seed))
+            system('rm -rf {}'.format(path))
     if not os.path.exists(os.path.join(path, '.git', 'config')):
-        clone_cmd = 'git clone --origin {} {} {}'.format(remote, url, path)
+        reference = get_reference(origin_url or url, sha1, path, opts, url)
+        options = get_clone_options(opts)
+        if reference:
+            options += ' --reference {}'.format(reference)
+        clone_cmd = 'git clone{} --origin {} {} {}'.format(options, remote, url, path)
         try:
             out, err = capture(clone_cmd, log=mylog)
         except Exception:
@@ -190,16 +592,32 @@ def checkout_repo_from_url(url, sha1, remote, path, mylog=log_info_sys):
             out, err = capture(clone_cmd, log=mylog)
         if out.strip():
             log.info(out.strip())
+        if reference:
+            from . import cache
+            cache.add_borrower(reference, os.path.join(getcwd(), path, '.git'))
         modified = True
+    apply_sparse(path, opts)
     checkout_cmd = 'git -C {} checkout {}'.format(path, sha1)
+    if not modified and opts.get('plans', dict()).get(path) == 'fetch-needed':
+        # Known to be missing, so do not bother trying the checkout first.
+        set_remote(url, remote, path)
+        fetch_sha1(path, remote, sha1, opts)
+        modified = True
     try:
         out, err = capture(checkout_cmd, log=mylog)
     except Exception as e:
         log.debug('SHA1 needed. Fetching.', exc_info=True)
         set_remote(url, remote, path)
-        system('git -C {} fetch {}'.format(path, remote))
+        fetch_sha1(path, remote, sha1, opts)
         modified = True
-        out, err = capture(checkout_cmd, log=mylog)
+        try:
+            out, err = capture(checkout_cmd, log=mylog)
+        except Exception:
+            if not is_shallow(path):
+                raise
+            log.warning('{} is not within the shallow history of {}. Unshallowing.'.format(sha1, path))
+            system('git -C {} fetch --unshallow {}'.format(path, remote))
+            out, err = capture(checkout_cmd, log=mylog)
     if 'Previous' in err:
         log.log(info_mod, '{}\n{}'.format(
             checkout_cmd, err.strip()))
@@ -208,6 +626,7 @@ def checkout_repo_from_url(url, sha1, remote, path, mylog=log_info_sys):
     if out:
         # This seems to be always empty, but I am not positive.
         log.debug('Result of "{}":\n{}"', checkout_cmd, out.strip())
+    return modified
 
 def getgithubname(remote):
     """
@@ -301,106 +720,542 @@ def get_mirror_dir(cwd, mirrors_base):
     return os.path.join(mirrors_base, ext, pi)
 
 def get_sha1(path):
+    """Return sha1 of HEAD, without a subprocess if possible.
+    """
+    try:
+        return refs.read_head(os.path.join(getcwd(), path))
+    except refs.ResolveError:
+        log.debug('Falling back on git for HEAD of {!r}.'.format(path), exc_info=True)
     stdout, stderr = capture('git -C {} rev-parse HEAD'.format(path), log=log_debug_sys)
     if stderr.strip():
         log.debug('stdout="{!r}", stderr="{!r}"'.format(stdout, stderr))
     return stdout.strip()
 
-def _checkout_repo(conf, mirrors_base):
+def get_mirror_url(mirrors_base, path):
+    if ':' in mirrors_base:
+        return os.path.join(mirrors_base, path)
+    else:
+        # Not really a URL. Just a path. So 'git clone' would imply '--local', which is good.
+        return os.path.join(get_mirror_dir(getcwd(), mirrors_base), path)
+
+def is_repo(path):
+    """Is there a working-tree at path? (Its .git might be a gitfile, as in a worktree.)
+    """
+    try:
+        gitdir = refs.find_git_dir(os.path.join(getcwd(), path))
+    except refs.ResolveError:
+        return False
+    return bool(gitdir) and os.path.exists(os.path.join(refs.find_common_dir(gitdir), 'config'))
+
+def _checkout_repo(conf, mirrors_base, opts=None):
+    opts = get_repo_opts(conf, opts)
     path = conf['path']
     sha1 = conf['sha1']
     url = conf['url']
-    if os.path.exists(os.path.join(path, '.git', 'config')):
-        if sha1 == get_sha1(path):
+    if is_repo(path):
+        if sha1 == get_sha1(path) and is_sparse_as_wanted(path, opts):
             log.info('{} is already on {}'.format(path, sha1))
             return
     log_info_mod('checkout_repo at {!r}'.format(path))
-    if 'nanofluidics' in url:
+    if opts.get('worktrees'):
+        from . import worktree
+        mirror_url = None
+        if mirrors_base and 'nanofluidics' not in url:
+            mirror_url = get_mirror_url(mirrors_base, path)
+        worktree.checkout_repo(conf, mirror_url, opts)
+        return
+    if 'nanofluidics' in url or not mirrors_base:
         # This is repo is already in local BitBucket, so do not bother with the mirror.
-        checkout_repo_from_url(url, sha1, 'origin', path)
+        sources = [('origin', url)]
+    else:
+        sources = [('mirror', get_mirror_url(mirrors_base, path)), ('origin', url)]
+    from . import remotes
+    sources = remotes.order(sources, path)
+    raced = False
+    if opts.get('race') and len(sources) > 1 and not is_repo(path) and path not in opts.get('seeds', dict()):
+        winner = remotes.race_clone(sources, path, get_clone_options(opts))
+        sources = [winner] + [source for source in sources if source != winner]
+        raced = True
+    failures = dict()
+    for i, (remote, src) in enumerate(sources):
+        start = time.time()
+        try:
+            modified = checkout_repo_from_url(src, sha1, remote, path, opts=opts, origin_url=url)
+        except Exception as e:
+            if remotes.is_transport_error(str(e)):
+                remotes.record(src, time.time() - start, False)
+            failures[remote] = sys.exc_info()
+            # The mirror is updated only every 6 hours, so this can be common.
+            log.debug('Failure to checkout from {}:\n{}.'.format(remote, traceback.format_exc()))
+            if i < len(sources) - 1:
+                log.warning('Failed to checkout "{}" from {} "{}". Repo is unavailable or not yet up-to-date. Trying {} next.'.format(
+                    path, remote, src, sources[i+1][0]))
+            continue
+        if modified and not raced:
+            # Only network work tells us about the remote.
+            remotes.record(src, time.time() - start, True, path)
+        if remote != 'origin':
+            set_remote(url, 'origin', path) # for convenient command-line work by users
         return
+    # Every source failed. The error of the origin is the one that matters;
+    # a mirror might merely be behind.
+    primary = 'origin' if 'origin' in failures else sources[0][0]
+    for remote, (_, exc_value, _) in sorted(failures.items()):
+        if remote != primary:
+            log.warning('Checkout of "{}" from {} failed too: {}'.format(path, remote, str(exc_value).strip()))
+    exc_type, exc_value, tb = failures[primary]
+    raise exc_type, exc_value, tb
+
+def list_submodules(path):
+    """Return [(name, subpath, url)] from .gitmodules, or [].
+    """
     try:
-        if ':' in mirrors_base:
-            mirror_url = os.path.join(mirrors_base, path)
-        else:
-            # Not really a URL. Just a path. So 'git clone' would imply '--local', which is good.
-            mirror_url = os.path.join(get_mirror_dir(os.getcwd(), mirrors_base), path)
-        checkout_repo_from_url(mirror_url, sha1, 'mirror', path)
-        set_remote(url, 'origin', path) # for convenient command-line work by users
-    except Exception as e:
-        # The mirror is updated only every 6 hours, so this can be common.
-        log.debug('Failure to contact mirror:\n{}.'.format(traceback.format_exc()))
-        log.warning('Failed to checkout "{}" from mirror "{}". Mirror repo is unavailable or not yet up-to-date. But GitHub checkout should still work.'.format(
-            path, mirror_url))
-        checkout_repo_from_url(url, sha1, 'origin', path)
-
-def update_submodules(path):
-    cmd = 'git -C {} submodule update --init --remote --recursive'.format(path)
+        out, _ = capture("git -C {} config -f .gitmodules --get-regexp '^submodule\\..*\\.(path|url)$'".format(path),
+                log=log_debug_sys)
+    except IOError:
+        return list()
+    subs = collections.defaultdict(dict)
+    for line in out.splitlines():
+        key, _, val = line.partition(' ')
+        name, _, attr = key[len('submodule.'):].rpartition('.')
+        subs[name][attr] = val
+    return sorted((name, sub['path'], sub.get('url', '')) for name, sub in subs.iteritems() if 'path' in sub)
+
+def get_submodule_mirror_url(mirror_url, url):
+    """A submodule's mirror is a sibling of its parent's, named for its repo.
+    >>> get_submodule_mirror_url('git://mirror/pbbam', 'git@github.com:PacificBiosciences/htslib.git')
+    'git://mirror/htslib'
+    """
+    name = url.rstrip('/').split('/')[-1].split(':')[-1]
+    if name.endswith('.git'):
+        name = name[:-4]
+    return os.path.join(os.path.dirname(mirror_url), name)
+
+def recover_submodule(path, name, subpath, cmd):
+    """Re-initialize only this submodule, discarding only its object store.
+    """
+    try:
+        system('{} -- {}'.format(cmd, subpath))
+        return
+    except IOError:
+        log.exception('Removing submodule "{}" of "{}" and retrying.'.format(name, path))
+    # deinit can fail when the submodule is badly broken, so clean up anyway.
+    system('git -C {} submodule deinit -f -- {}'.format(path, subpath), checked=False)
+    gitdir = refs.find_git_dir(os.path.join(getcwd(), path))
+    for d in (os.path.join(gitdir, 'modules', name), os.path.join(getcwd(), path, subpath)):
+        if os.path.exists(d):
+            shutil.rmtree(d)
+    system('{} -- {}'.format(cmd, subpath))
+
+def update_submodules(path, mirror_url=None, jobs=1):
+    """Submodules are fetched in parallel (--jobs).
+    With mirror_url (of the parent), first populate them from the mirror,
+    then update from their own remotes, which fetches only what is new.
+    On failure, recover each submodule separately, so healthy ones keep
+    their object stores. Try them all, then raise once for those which failed.
+    """
+    subs = list_submodules(path)
+    if not subs:
+        return
+    if mirror_url:
+        rewrites = ''.join(' -c url.{}.insteadOf={}'.format(get_submodule_mirror_url(mirror_url, url), url)
+                for name, subpath, url in subs if url)
+        if ':' not in mirror_url:
+            # We chose this local mirror, so trust it. (git>=2.38.1 forbids local submodules by default.)
+            rewrites += ' -c protocol.file.allow=always'
+        try:
+            system('git -C {}{} submodule update --init --recursive --jobs {}'.format(path, rewrites, jobs))
+        except IOError:
+            log.warning('Failed to update submodules of "{}" from the mirror. Their own remotes should still work.'.format(path))
+    cmd = 'git -C {} submodule update --init --remote --recursive --jobs {}'.format(path, jobs)
     try:
         system(cmd)
-    except Exception:
-        log.exception("We will remove all submodules and retry.")
-        system('git -C {} submodule deinit -f .'.format(path))
-        system('rm -rf {}/.git/modules'.format(path))
-        system(cmd)
+    except IOError:
+        log.exception('Failed to update submodules of "{}". Recovering each one separately.'.format(path))
+        failed = list()
+        for name, subpath, url in subs:
+            try:
+                recover_submodule(path, name, subpath, cmd)
+            except Exception:
+                log.exception('Failed to recover submodule "{}" of "{}".'.format(name, path))
+                failed.append(subpath)
+        if failed:
+            raise IOError('Failed to recover submodules of "{}": {}'.format(path, ', '.join(failed)))
 
-def checkout_repo(conf, mirrors_base):
-    _checkout_repo(conf, mirrors_base)
+def checkout_repo(conf, mirrors_base, opts=None):
+    _checkout_repo(conf, mirrors_base, opts)
     if 'submodules' in conf:
         path = conf['path']
-        update_submodules(path)
+        opts = opts or dict()
+        mirror_url = None
+        if mirrors_base and 'nanofluidics' not in conf['url']:
+            mirror_url = get_mirror_url(mirrors_base, path)
+        update_submodules(path, mirror_url, opts.get('jobs', 1))
+
+def read_journal(fn):
+    """Return dict(name: entry) from the last checkout, or {}.
+    """
+    try:
+        with open(fn) as fp:
+            return json.load(fp)['repos']
+    except Exception:
+        log.debug('No usable journal {!r}.'.format(fn), exc_info=True)
+        return dict()
+
+def write_journal(fn, repos):
+    tmp = fn + '.tmp'
+    with open(tmp, 'w') as fp:
+        json.dump(dict(repos=repos), fp, indent=2, sort_keys=True)
+    os.rename(tmp, fn)
+
+def get_journal_entry(cfg, sha1=None):
+    """Return dict(ini, sha1, head_mtime), or None if there is no repo yet.
+    'ini' is a hash of the config. No git subprocess is needed.
+    """
+    try:
+        gitdir = refs.find_git_dir(os.path.join(getcwd(), cfg['path']))
+        head_mtime = os.stat(os.path.join(gitdir, 'HEAD')).st_mtime
+    except Exception:
+        return None
+    ini = hashlib.sha1(json.dumps(cfg, sort_keys=True)).hexdigest()
+    return dict(ini=ini, sha1=sha1 or cfg['sha1'], head_mtime=head_mtime)
+
+def is_unchanged(cfg, entry):
+    """Is the repo exactly as the last checkout left it?
+    Repos with submodules always need an update (--remote).
+    HEAD's mtime misses a commit on a branch (which moves only the branch ref),
+    so also resolve HEAD, in pure python.
+    """
+    if not entry or 'submodules' in cfg:
+        return False
+    current = get_journal_entry(cfg)
+    if not current or current['ini'] != entry['ini'] or current['head_mtime'] != entry['head_mtime']:
+        return False
+    try:
+        return refs.read_head(os.path.join(getcwd(), cfg['path'])) == entry['sha1'] == cfg['sha1']
+    except refs.ResolveError:
+        return False
+
+def write_if_changed(fn, content):
+    """Return True if we wrote.
+    """
+    if os.path.exists(fn):
+        with open(fn) as fp:
+            if fp.read() == content:
+                return False
+    with open(fn, 'w') as ofs:
+        ofs.write(content)
+    return True
 
 def checkout(args):
     init(args)
+    from . import mirrors
     with cd(args.directory):
+        mirrors_base = mirrors.resolve(args.mirrors)
         # Directories are relative to the location of ini files, for now.
         repos = read_modules(args)
-        for repo, cfg in sorted(repos.iteritems()):
-            checkout_repo(cfg, args.mirrors)
+        opts = dict(cache_dir=args.cache, fetch=args.fetch, depth=args.depth, filter=args.filter,
+                jobs=args.jobs, worktrees=args.worktrees, race=args.race,
+                seeds=getattr(args, 'seeds', None) or dict())
+        journal = dict() if args.force else read_journal(args.journal)
+        new_journal = dict()
+        from . import schedule
+        def checkout_one(item):
+            name, cfg = item
+            entry = journal.get(name)
+            if is_unchanged(cfg, entry):
+                log.info('{} is unchanged since the last checkout.'.format(cfg['path']))
+            else:
+                before = get_sha1(cfg['path']) if is_repo(cfg['path']) else None
+                start = time.time()
+                with trace.context(repo=name):
+                    checkout_repo(cfg, mirrors_base, opts)
+                if before != cfg['sha1'] or 'submodules' in cfg:
+                    # A repo which was already there tells us nothing.
+                    schedule.record(cfg['url'], time.time() - start, schedule.get_phases(name))
+                entry = get_journal_entry(cfg, get_sha1(cfg['path']))
+            if entry:
+                new_journal[name] = entry
+        from . import plan
+        items = sorted(repos.iteritems())
+        changed = [(name, cfg) for name, cfg in items if not is_unchanged(cfg, journal.get(name))]
+        plans = plan.plan_repos(changed, opts, args.jobs)
+        opts['plans'] = dict((repos[name]['path'], p) for name, p in plans.iteritems())
+        if args.jobs > 1:
+            def expected(item):
+                name, cfg = item
+                if name not in plans or plans[name] == plan.UP_TO_DATE:
+                    return 0.0
+                return schedule.estimate(cfg, mirrors_base, opts)
+            items = schedule.longest_first(items, expected)
+            # Network work first, since it is the slowest and least predictable.
+            items.sort(key=lambda item: plans.get(item[0]) not in plan.NETWORK)
+            log.debug('Checkout order: {!r}'.format([name for name, _ in items]))
+        try:
+            parallel_map(checkout_one, items, args.jobs)
+        finally:
+            write_journal(args.journal, new_journal)
+            try:
+                schedule.write_timings()
+            except Exception:
+                log.debug('Cannot save timings.', exc_info=True)
+        if args.maintain:
+            from . import maintain
+            maintain.auto(repos, args.jobs)
+        if args.cache:
+            from . import cache
+            cache.prune(args.cache, cache.parse_size(args.cache_size))
         try:
-            with open(args.manifest, 'w') as ofs:
-                ofs.write(manifest(repos.values()))
-            with open(args.csv, 'w') as ofs:
-                ofs.write(csv_manifest(repos.values()))
+            write_if_changed(args.manifest, manifest(repos.values()))
+            write_if_changed(args.csv, csv_manifest(repos.values()))
         except Exception:
             log.exception('Unable to write manifests {!r} {!r}'.format(args.manifest, args.csv))
 
-@contextmanager
-def tempdir():
-    dirpath = tempfile.mkdtemp()
-    def cleanup():
-        shutil.rmtree(dirpath)
-    with cd(dirpath, cleanup):
-        yield dirpath
+def get_empty_repo():
+    """Return a bare repo with nothing in it, created once.
+    """
+    gitdir = os.path.join(get_state_dir(), 'empty.git')
+    if not os.path.isdir(gitdir):
+        mkdirs(get_state_dir())
+        tmp = '{}.{}.{}.tmp'.format(gitdir, os.getpid(), threading.current_thread().ident)
+        capture('git init --quiet --bare {}'.format(tmp), log=log_debug_sys)
+        try:
+            os.rename(tmp, gitdir)
+        except OSError:
+            if not os.path.isdir(gitdir):
+                raise
+            shutil.rmtree(tmp) # Someone else made it first.
+    return gitdir
+
+def get_no_lazy_fetch_env(gitdir):
+    """Environment for reading the objects of gitdir without ever fetching.
+    In a partial clone, git fetches any missing object it is asked about.
+    So git reads the object store through an empty repo, which has no
+    promisor remote. (GIT_NO_LAZY_FETCH is only for git >= 2.44.)
+    """
+    objects = os.path.join(refs.find_common_dir(os.path.join(getcwd(), gitdir)), 'objects')
+    return dict(os.environ, GIT_DIR=get_empty_repo(), GIT_OBJECT_DIRECTORY=objects, GIT_NO_LAZY_FETCH='1')
+
+def has_commit(gitdir, sha1):
+    """Never fetches, even in a partial clone.
+    """
+    call = 'git cat-file -e {}^{{commit}}'.format(sha1)
+    log.debug('`{}` in {}'.format(call, gitdir))
+    returncode, _, _ = trace.run(call, env=get_no_lazy_fetch_env(gitdir), cwd=getcwd())
+    return returncode == 0
+
+def get_scratch_dir(url):
+    from . import cache
+    return os.path.join(get_state_dir(), 'verify', cache.url_key(url) + '.git')
+
+def get_scratch_repo(url):
+    """Return gitdir of a bare repo for verifying commits from url.
+    It is reused across runs, and it only ever fetches from url, so
+    anything in it was served by url.
+    """
+    gitdir = get_scratch_dir(url)
+    if not os.path.isdir(gitdir):
+        tmp = '{}.{}.tmp'.format(gitdir, os.getpid())
+        capture('git init --quiet --bare {}'.format(tmp), log=log_debug_sys)
+        capture('git --git-dir={} remote add origin {}'.format(tmp, url), log=log_debug_sys)
+        # Partial clone, so we can ask for a commit without its trees and blobs.
+        capture('git --git-dir={} config remote.origin.promisor true'.format(tmp), log=log_debug_sys)
+        capture('git --git-dir={} config extensions.partialClone origin'.format(tmp), log=log_debug_sys)
+        os.rename(tmp, gitdir)
+    return gitdir
 
 def verify_repo_slow(name, cfg, sha1):
-    # We expect this to occur in a temp-dir.
-    mkdirs(name)
-    with cd(name):
-        path = cfg['path']
-        sha1 = cfg['sha1']
-        url = cfg['url']
-        log_info_mod('Verifying GitHub repo {} contains {} with a full checkout in a tempdir.'.format(name, sha1))
-        checkout_repo_from_url(url, sha1, 'origin', path, mylog=log_debug_sys)
+    """Ask the origin URL for only this commit, into a persistent
+    bare scratch repo. No working-tree.
+    If the server refuses to send a single commit, fetch its branches.
+    """
+    from . import locks
+    url = cfg['url']
+    log_info_mod('Verifying GitHub repo {} contains {} by fetching only that commit.'.format(name, sha1))
+    with locks.get_lock(get_scratch_dir(url)):
+        gitdir = get_scratch_repo(url)
+        if has_commit(gitdir, sha1):
+            log.debug('{} was fetched from {} earlier.'.format(sha1, url))
+            return
+        fetch = 'git --git-dir={} fetch --quiet --no-tags --filter=tree:0'.format(gitdir)
+        try:
+            capture('{} --depth=1 origin {}'.format(fetch, sha1), log=log_debug_sys)
+        except IOError:
+            log.debug('Cannot fetch {} alone.'.format(sha1), exc_info=True)
+            capture('{} origin +refs/heads/*:refs/heads/*'.format(fetch), log=log_debug_sys)
+        assert has_commit(gitdir, sha1), '{} is not available from {}'.format(sha1, url)
         # TODO: Verify submodules too, if necessary.
 
+# Remote-tracking branches most likely to contain a pinned commit.
+LIKELY_BRANCHES = ('master', 'main', 'develop', 'HEAD')
+
+def order_remote_refs(tips):
+    """Given [(sha1, refname)], put likely branches first, and
+    skip refs whose tip we already have.
+    >>> order_remote_refs([('a', 'refs/remotes/origin/feature'), ('b', 'refs/remotes/mirror/master'), ('b', 'refs/remotes/origin/master')])
+    [('b', 'refs/remotes/mirror/master'), ('a', 'refs/remotes/origin/feature')]
+    """
+    def priority(tip):
+        branch = tip[1].split('/', 3)[-1]
+        return LIKELY_BRANCHES.index(branch) if branch in LIKELY_BRANCHES else len(LIKELY_BRANCHES)
+    seen = set()
+    ordered = list()
+    for tip in sorted(tips, key=priority):
+        if tip[0] not in seen:
+            seen.add(tip[0])
+            ordered.append(tip)
+    return ordered
+
+def find_containing_ref(path, sha1):
+    """Return the first remote-tracking ref (origin or mirror) from which
+    sha1 is reachable, or None.
+    Only the likeliest branch is tried alone; otherwise, one walk checks every ref,
+    since a commit which was never pushed has to be checked against them all.
+    """
+    remotes = 'refs/remotes/origin refs/remotes/mirror'
+    out, _ = capture("git -C {} for-each-ref --format='%(objectname) %(refname)' {}".format(path, remotes),
+            log=log_debug_sys)
+    tips = order_remote_refs([tuple(line.split()) for line in out.splitlines() if line.strip()])
+    for tip, ref in tips:
+        if tip == sha1:
+            return ref
+    if not tips:
+        return None
+    tip, ref = tips[0]
+    call = 'git -C {} merge-base --is-ancestor {} {}'.format(path, sha1, tip)
+    log_debug_sys(call)
+    returncode, _, err = trace.run(call, cwd=getcwd())
+    if returncode == 0:
+        return ref
+    if returncode != 1:
+        raise IOError(err) # e.g. sha1 is not here at all
+    out, _ = capture("git -C {} for-each-ref --contains {} --format='%(refname)' {}".format(path, sha1, remotes),
+            log=log_debug_sys)
+    containing = set(out.split())
+    for tip, ref in tips:
+        if ref in containing:
+            return ref
+    return None
+
+def get_verified_fn():
+    return os.path.join(get_state_dir(), 'verified')
+
+_verified = None
+_verified_lock = threading.Lock()
+
+def read_verified():
+    """Return set of (normalized-url, sha1) from earlier runs.
+    """
+    global _verified
+    with _verified_lock:
+        if _verified is None:
+            _verified = set()
+            try:
+                with open(get_verified_fn()) as fp:
+                    for line in fp:
+                        parts = line.rstrip('\n').split(' ', 1)
+                        if len(parts) == 2:
+                            _verified.add((parts[1], parts[0]))
+            except IOError:
+                pass
+        return _verified
+
+def is_verified(url, sha1):
+    from . import cache
+    return (cache.normalize_url(url), sha1) in read_verified()
+
+def add_verified(url, sha1):
+    """Remember that sha1 is available from url.
+    """
+    from . import cache
+    key = (cache.normalize_url(url), sha1)
+    verified = read_verified()
+    with _verified_lock:
+        if key in verified:
+            return
+        verified.add(key)
+        fn = get_verified_fn()
+        mkdirs(os.path.dirname(fn))
+        # Short appends are atomic, so concurrent runs can share the file.
+        with open(fn, 'a') as fp:
+            fp.write('{} {}\n'.format(sha1, key[0]))
+
 def verify_repo_fast(name, cfg, sha1):
     path = cfg['path']
     log_info_mod('Verifying {} contains {} in a remote-tracking branch at ./{}'.format(name, sha1, path))
-    cmd = 'git -C {} branch -r --contains {}'.format(path, sha1)
-    out, err = capture(cmd)
-    assert ('origin' in out or 'mirror' in out), 'Reachable remote branches:\n{}\nOur SHA1 is not reachable from any tracking branch of the "origin" or "mirror" remotes.'.format(out)
+    ref = find_containing_ref(path, sha1)
+    # In a shallow clone, the history of the remote-tracking branches might
+    # be cut off before our SHA1. That is a false negative, never a false
+    # positive, so the slow way still decides.
+    shallow = ' (This is a shallow clone, so history might be truncated.)' if is_shallow(path) else ''
+    assert ref, 'Our SHA1 is not reachable from any tracking branch of the "origin" or "mirror" remotes.{}'.format(shallow)
+    log.debug('{} is reachable from {}'.format(sha1, ref))
 
 def verify_repo(name, cfg, sha1):
+    """Return 'cached', 'fast' or 'slow', to say how it was verified.
+    Raise on failure.
+    """
+    url = cfg['url']
+    if is_verified(url, sha1):
+        log.info('{} was already verified in {}.'.format(sha1, url))
+        return 'cached'
     try:
         verify_repo_fast(name, cfg, sha1)
+        how = 'fast'
     except Exception:
         # Someday: Maybe 'git fetch' in case the remote is not up-to-date?
         if VERBOSITY >= 4:
             log.exception('First attempt to verify "{}" failed.'.format(name))
         log.warning('Failed to verify "{}" the fast way. Trying the slow way...'.format(name))
-        with tempdir():
-            verify_repo_slow(name, cfg, sha1)
+        verify_repo_slow(name, cfg, sha1)
+        how = 'slow'
+    add_verified(url, sha1)
+    return how
+
+VerifyResult = collections.namedtuple('VerifyResult', ['name', 'sha1', 'how', 'seconds', 'error'])
+
+def verify_repos(changes, jobs=1):
+    """Verify each (name, cfg, sha1) concurrently.
+    Return a VerifyResult for each, in order. Failures do not raise;
+    they have how=None and the error message.
+    """
+    def verify_one(change):
+        name, cfg, sha1 = change
+        start = time.time()
+        try:
+            with trace.context(repo=name, phase='verify'):
+                how = verify_repo(name, cfg, sha1)
+            error = None
+        except Exception as e:
+            log.debug('Failed to verify "{}".'.format(name), exc_info=True)
+            how = None
+            error = str(e).strip() or repr(e)
+        return VerifyResult(name, sha1, how, time.time() - start, error)
+    return parallel_map(verify_one, changes, jobs)
+
+def verify_summary(results):
+    """Return a table of VerifyResults.
+    >>> print verify_summary([VerifyResult('foo', 'abc', 'fast', 0.25, None), VerifyResult('bar', 'def', None, 12.0, 'oops')])
+    Verified 1 of 2 repos:
+      ok     fast     0.2s foo abc
+      FAILED         12.0s bar def
+    """
+    lines = ['Verified {} of {} repos:'.format(
+        len([r for r in results if not r.error]), len(results))]
+    for r in results:
+        lines.append('  {:6} {:6} {:5.1f}s {} {}'.format(
+            'FAILED' if r.error else 'ok', r.how or '', r.seconds, r.name, r.sha1))
+    return '\n'.join(lines)
+
+def check_verified(results):
+    """Log the summary.
+    Raise once, listing every repo which failed.
+    """
+    log_info_mod(verify_summary(results))
+    failed = [r for r in results if r.error]
+    if failed:
+        raise Exception('Failed to verify {} repos:\n'.format(len(failed)) + '\n'.join(
+            '{} {}: {}'.format(r.name, r.sha1, r.error) for r in failed))
 
 def verify(args):
     """Check with GitHub to see whether These commits are available.
@@ -426,16 +1281,13 @@ def verify(args):
     init(args)
     with cd(args.directory):
         repos = read_modules(args)
-        sha1s = dict()
-        for name, cfg in repos.iteritems():
+        changes = list()
+        for name, cfg in sorted(repos.iteritems()):
             path = cfg['path']
-            sha1new, errs = capture('git -C {} rev-parse HEAD'.format(path))
-            if errs:
-                log.debug(errs)
-            sha1new = sha1new.strip()
+            sha1new = get_sha1(path)
             log.debug('Expecting {} @ {}'.format(path, sha1new))
-            sha1s[name] = sha1new
-            verify_repo(name, cfg, sha1s[name])
+            changes.append((name, cfg, sha1new))
+        check_verified(verify_repos(changes, args.jobs))
 
 def prepare(args):
     """
@@ -464,12 +1316,9 @@ def prepare(args):
 
         repos = read_modules(args)
         changes = list()
-        for name, cfg in repos.iteritems():
+        for name, cfg in sorted(repos.iteritems()):
             path = cfg['path']
-            sha1new, errs = capture('git -C {} rev-parse HEAD'.format(path))
-            if errs:
-                log.debug(errs)
-            sha1new = sha1new.strip()
+            sha1new = get_sha1(path)
             log.debug('Preparing {} {} {}'.format(sha1new, name, path))
             if sha1new == cfg['sha1']:
                 continue
@@ -481,30 +1330,50 @@ def prepare(args):
             with open(prepared, 'w') as fp:
                 log_info_mod('Writing to {!r}'.format(prepared))
                 write_repo_config(fp, cfg)
-            capture('p4 edit {}'.format(fnold), log=log_info_mod)
             changes.append((name, cfg, sha1new))
+        p4_batch('edit', [name + '.ini' for name, cfg, sha1 in changes])
         if not args.no_verify:
             # Verify that changes are available in GitHub.
-            for name, cfg, sha1 in changes:
-                verify_repo(name, cfg, sha1)
+            check_verified(verify_repos(changes, args.jobs))
         msg = prepare_for_submit()
         capture('p4 diff ...')
         sys.stdout.write('Please add these links to your submit message:\n' + msg)
 
+def p4_batch(cmd, fns, log=log_info_mod):
+    """Run one p4 command for all fns, via an argument file.
+    Return stdout, stderr.
+    """
+    if not fns:
+        return '', ''
+    import tempfile
+    fd, argfile = tempfile.mkstemp(prefix='pb-git-p4.', suffix='.txt')
+    try:
+        with os.fdopen(fd, 'w') as fp:
+            fp.write('\n'.join(fns) + '\n')
+        log('p4 {} {}'.format(cmd, ' '.join(fns)))
+        return capture('p4 -x {} {}'.format(argfile, cmd), log=log)
+    finally:
+        os.remove(argfile)
+
+def same_ignoring_whitespace(fna, fnb):
+    """Like 'diff -qw'.
+    """
+    def lines(fn):
+        with open(fn) as fp:
+            return [re.sub(r'\s+', '', line) for line in fp]
+    return lines(fna) == lines(fnb)
+
 def prepare_for_submit():
     """Assume this is running in parent dir of git-modules.
     Return http links to be added to the submit-message.
     """
     mout = StringIO.StringIO()
-    system_perm = functools.partial(capture, log=log_info_mod)
-    for fnnew in glob.glob('*.ini.bak'):
+    for fnnew in sorted(glob.glob('*.ini.bak')):
         fnold = fnnew[:-4]
-        try:
-            capture('diff -qw {} {}'.format(fnnew, fnold))
-            system_perm('rm -f {}'.format(fnnew))
+        if same_ignoring_whitespace(fnnew, fnold):
+            log_info_mod('Removing {!r}'.format(fnnew))
+            os.remove(fnnew)
             continue
-        except IOError:
-            pass # They differ.
         with open(fnold) as fp:
             cfgold = read_repo_config(fp)
         with open(fnnew) as fp:
@@ -516,8 +1385,7 @@ def prepare_for_submit():
         compare_link = 'https://github.com/{}/{}/compare/{}...{}'.format(
             gh_user, gh_repo, sha1old, sha1new)
         mout.write('{}\n'.format(compare_link))
-        system_perm('mv -f {} {}'.format(fnnew, fnold))
-    system_perm('p4 revert -a ...')
+        rename(fnnew, fnold)
+    capture('p4 revert -a ...', log=log_info_mod)
     msg = mout.getvalue()
     return msg
-
@@ -5,6 +5,7 @@ served its purpose, we can delete this file.
 # Chris, Can this still be
 # useful for pulling new submodule sets into p4?
 # Implement 'pb-git add' first, then see.
+from __future__ import absolute_import
 from . import cmds
 import ConfigParser as configparser
 import os
@@ -48,6 +49,42 @@ def gitmodules_as_config(content):
     log.info(config)
     return config
 
+def read_gitmodules(directory):
+    """Return dict(name: dict(path, url, ...)) from directory/.gitmodules.
+    """
+    gitmodules = os.path.join(directory, '.gitmodules')
+    log.info('Reading "{}"...'.format(gitmodules))
+    fp = StringIO.StringIO(gitmodules_as_config(open(gitmodules).read()))
+    cp = configparser.ConfigParser()
+    cp.readfp(fp)
+    re_name = re.compile(r'submodule "(.*)"')
+    repos = dict()
+    for sec in cp.sections():
+        log.info(sec)
+        name = re_name.search(sec).group(1)
+        repos[name] = dict(cp.items(sec))
+    return repos
+
+def find_seeds(directory):
+    """Return dict(path: gitdir) of the submodule object stores
+    already under directory (a git-submodules parent repo).
+    """
+    seeds = dict()
+    modules = read_gitmodules(directory)
+    checked_out = get_submodule_sha1s(directory)
+    for name, data in modules.iteritems():
+        path = data.get('path', name)
+        if path not in checked_out:
+            log.info('Submodule "{}" is not in `git submodule status`.'.format(path))
+        # Modern git keeps them in .git/modules/NAME. Older git left a .git/ in the submodule.
+        for gitdir in (os.path.join(directory, '.git', 'modules', name), os.path.join(directory, path, '.git')):
+            if os.path.isdir(os.path.join(gitdir, 'objects')):
+                seeds[path] = gitdir
+                break
+        else:
+            log.warning('No object store for submodule "{}" in "{}". It will be cloned.'.format(path, directory))
+    return seeds
+
 def convert(args):
     """Using .git and .gitmodules from args.directory,
     write *.ini for each submodule, after moving
@@ -62,18 +99,8 @@ def convert(args):
     group['repos'] = repos
     # For now, require full path to '.gitmodules'.
     directory = os.path.abspath(args.directory)
-    gitmodules = os.path.join(directory, '.gitmodules')
-    log.info('Converting from "{}"...'.format(gitmodules))
-    fp = StringIO.StringIO(gitmodules_as_config(open(gitmodules).read()))
-    cp = configparser.ConfigParser()
-    cp.readfp(fp)
-    re_name = re.compile(r'submodule "(.*)"')
-    for sec in cp.sections():
-        log.info(sec)
-        name = re_name.search(sec).group(1)
-        items = cp.items(sec)
-        data = dict(items)
-        repos[name] = data
+    log.info('Converting from "{}"...'.format(directory))
+    repos.update(read_gitmodules(directory))
     log.info(repr(repos))
     sha1s = get_submodule_sha1s(directory)
     assert sorted(sha1s.keys()) == sorted(repos.keys())
@@ -94,9 +121,13 @@ def convert(args):
 def migrate(args):
     """Move old git-submodules parent repo,
     'p4 sync -f dir',
-    and re-checkout.
+    and re-checkout, seeding each repo from the old object stores.
     """
     cmds.init(args)
+    # For the 'checkout' args which the migrate command-line lacks.
+    for key, val in cmds.get_checkout_defaults().iteritems():
+        if not hasattr(args, key):
+            setattr(args, key, val)
     # We used to move and re-create, but that is not really needed immediately.
     # The submodules can exist until a new one is added. Even then,
     # things will work until someone actually performs a
@@ -104,6 +135,11 @@ def migrate(args):
     directory = os.path.abspath(args.directory)
     cmds.rename(directory, directory + '.bak')
     log.warning('Your old work is now in "{}".'.format(directory + '.bak'))
+    try:
+        args.seeds = find_seeds(directory + '.bak')
+    except Exception:
+        log.exception('Cannot find the old submodule object stores. Cloning everything.')
+        args.seeds = dict()
     cmds.system('p4 sync -f {}/...'.format(directory))
     cmds.checkout(args)
     log.warning('To reiterate, your old work is now in "{}".'.format(directory + '.bak'))
@@ -0,0 +1,127 @@
+"""
+Export source snapshots: the files at a SHA1, with no git history.
+
+Archives (tar.gz, from 'git archive') are cached by (url, sha1), as
+    EXPORT_DIR/<url-key>/<sha1>.tar.gz
+so an unchanged repo costs nothing. An unpacked path remembers its
+SHA1 in STAMP, so re-unpacking is skipped too.
+"""
+from __future__ import absolute_import
+from . import cmds
+from . import refs
+from . import trace
+import os
+import shutil
+import sys
+import tarfile
+
+log = cmds.log
+
+EXPORT_DIR_ENV = 'PB_GIT_EXPORT_DIR'
+STAMP = '.pb-git-export'
+
+def get_default_export_dir():
+    return os.environ.get(EXPORT_DIR_ENV, os.path.join(cmds.get_state_dir(), 'export'))
+
+def get_archive(export_dir, url, sha1):
+    from . import cache
+    return os.path.join(os.path.abspath(export_dir), cache.url_key(url), sha1 + '.tar.gz')
+
+def archive_from(gitdir, sha1, archive):
+    tmp = '{}.{}.tmp'.format(archive, os.getpid())
+    cmds.capture('git --git-dir={} archive --format=tar.gz -o {} {}'.format(gitdir, tmp, sha1), log=cmds.log_info_sys)
+    os.rename(tmp, archive)
+
+def fetch_commit(gitdir, url, sha1):
+    """Fetch only sha1 (no history) into the empty bare repo gitdir.
+    If the server refuses to send it alone, fetch everything.
+    """
+    cmds.capture('git init --quiet --bare {}'.format(gitdir), log=cmds.log_debug_sys)
+    try:
+        cmds.capture('git --git-dir={} fetch --quiet --depth=1 {} {}'.format(gitdir, url, sha1), log=cmds.log_info_sys)
+    except IOError:
+        log.warning('Remote "{}" refused to send {} alone. Fetching everything.'.format(url, sha1))
+        cmds.capture('git --git-dir={} fetch --quiet {} +refs/heads/*:refs/heads/*'.format(gitdir, url), log=cmds.log_info_sys)
+
+def ensure_archive(export_dir, cfg):
+    """Return the cached archive for cfg, building it if needed.
+    Use the local checkout at cfg['path'] if it has the commit.
+    """
+    from . import locks
+    url, sha1, path = cfg['url'], cfg['sha1'], cfg['path']
+    archive = get_archive(export_dir, url, sha1)
+    with locks.get_lock(archive):
+        if os.path.exists(archive):
+            log.debug('{} is in the export cache: {}'.format(path, archive))
+            return archive
+        cmds.mkdirs(os.path.dirname(archive))
+        if cmds.is_repo(path):
+            gitdir = refs.find_git_dir(os.path.join(cmds.getcwd(), path))
+            if cmds.has_commit(gitdir, sha1):
+                archive_from(gitdir, sha1, archive)
+                return archive
+        scratch = archive + '.git.{}.tmp'.format(os.getpid())
+        try:
+            fetch_commit(scratch, url, sha1)
+            archive_from(scratch, sha1, archive)
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+    return archive
+
+def read_stamp(path):
+    try:
+        with open(os.path.join(path, STAMP)) as fp:
+            return fp.read().strip()
+    except IOError:
+        return None
+
+def unpack(archive, path, sha1):
+    """Replace the files at path with the archive.
+    Only an earlier export (with its STAMP) or an empty directory is replaced.
+    """
+    stamp = read_stamp(path)
+    if stamp == sha1:
+        log.info('{} is already exported at {}'.format(path, sha1))
+        return
+    if cmds.is_repo(path):
+        raise Exception('"{}" is a git checkout. Not replacing it with an export.'.format(path))
+    if stamp is None and os.path.exists(path) and not (os.path.isdir(path) and not os.listdir(path)):
+        raise Exception('"{}" exists, but is not an export (no {}). Not replacing it.'.format(path, STAMP))
+    cmds.log_info_mod('Unpacking {} into {!r}'.format(sha1, path))
+    tmp = '{}.{}.tmp'.format(path.rstrip('/'), os.getpid())
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    tf = tarfile.open(archive)
+    try:
+        tf.extractall(tmp)
+    finally:
+        tf.close()
+    with open(os.path.join(tmp, STAMP), 'w') as fp:
+        fp.write(sha1 + '\n')
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp, path)
+
+def export(args):
+    """Build (or find) an archive for every repo in the ini files,
+    and unpack them if asked.
+    """
+    cmds.init(args)
+    export_dir = os.path.abspath(args.export_dir or get_default_export_dir())
+    with cmds.cd(args.directory):
+        repos = cmds.read_modules(args)
+        def export_one(item):
+            name, cfg = item
+            with trace.context(repo=name):
+                archive = ensure_archive(export_dir, cfg)
+                if args.unpack:
+                    unpack(archive, cfg['path'], cfg['sha1'])
+            return (cfg['path'], cfg['sha1'], archive)
+        results = cmds.parallel_map(export_one, sorted(repos.iteritems()), args.jobs)
+        try:
+            cmds.write_if_changed(args.manifest, cmds.manifest(repos.values()))
+            cmds.write_if_changed(args.csv, cmds.csv_manifest(repos.values()))
+        except Exception:
+            log.exception('Unable to write manifests {!r} {!r}'.format(args.manifest, args.csv))
+    for path, sha1, archive in sorted(results):
+        sys.stdout.write('{} {} {}\n'.format(sha1, archive, path))
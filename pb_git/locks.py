@@ -0,0 +1,225 @@
+"""
+Locks which work across processes and hosts, on NFS or Lustre too.
+
+A lock on PATH is the directory 'PATH.lock', since mkdir is atomic even
+where O_EXCL and flock() are not reliable. It holds an 'owner' file
+(host, pid), whose mtime the holder refreshes every HEARTBEAT seconds.
+The owner file is created with link(), which is atomic on NFS too, so
+only one process can ever claim a lock directory.
+
+A lock whose owner file is older than STALE_AFTER seconds, or whose
+owner is a dead process on this host, is taken over by a waiter. The
+lock directory is never removed by anyone but its holder. A waiter
+renames the stale owner file aside, which only one of them can do.
+It then checks that the file is still the one it judged stale,
+restoring it otherwise, and claims the directory for itself.
+
+So when many jobs need the same mirror or cache entry at once, one
+fetches while the others wait, and then they find the result ready.
+"""
+from __future__ import absolute_import
+from . import cmds
+import errno
+import json
+import os
+import shutil
+import socket
+import threading
+import time
+
+log = cmds.log
+
+STALE_ENV = 'PB_GIT_LOCK_STALE'
+STALE_AFTER = 120
+HEARTBEAT = 10
+POLL = 0.2
+OWNER = 'owner'
+
+_thread_locks = dict()
+_thread_locks_lock = threading.Lock()
+
+class LockTimeout(Exception):
+    pass
+
+def get_thread_lock(key):
+    """Threads of one process also exclude each other, without polling.
+    """
+    with _thread_locks_lock:
+        return _thread_locks.setdefault(key, threading.Lock())
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+class FileLock(object):
+    """Context manager. Not re-entrant.
+    """
+    def __init__(self, path, stale_after=None, timeout=None):
+        self.lockdir = os.path.abspath(path) + '.lock'
+        if stale_after is None:
+            stale_after = float(os.environ.get(STALE_ENV, STALE_AFTER))
+        self.stale_after = stale_after
+        self.timeout = timeout
+        self.owner = dict(host=socket.gethostname(), pid=os.getpid())
+        self._thread_lock = get_thread_lock(self.lockdir)
+        self._stop = None
+        self._heartbeat = None
+    def __enter__(self):
+        self.acquire()
+        return self
+    def __exit__(self, *exc):
+        self.release()
+    def acquire(self):
+        start = time.time()
+        if not self._thread_lock.acquire(False):
+            log.debug('Waiting for another thread to release "{}".'.format(self.lockdir))
+            if self.timeout is None:
+                self._thread_lock.acquire()
+            else:
+                # No timeout for threading.Lock in python2.
+                while not self._thread_lock.acquire(False):
+                    if time.time() - start > self.timeout:
+                        raise LockTimeout('Timed out after {}s waiting for "{}".'.format(self.timeout, self.lockdir))
+                    time.sleep(POLL)
+        try:
+            self._acquire(start)
+        except BaseException:
+            self._thread_lock.release()
+            raise
+    def release(self):
+        self._stop.set()
+        self._heartbeat.join()
+        owner = self.read_owner()
+        if owner and (owner['host'], owner['pid']) == (self.owner['host'], self.owner['pid']):
+            shutil.rmtree(self.lockdir, ignore_errors=True)
+        else:
+            log.warning('Lock "{}" was broken while we held it. Now held by {}.'.format(self.lockdir, owner or 'nobody'))
+        self._thread_lock.release()
+    def _acquire(self, start):
+        waited = False
+        while True:
+            try:
+                os.makedirs(os.path.dirname(self.lockdir))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            try:
+                os.mkdir(self.lockdir)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            else:
+                if self.claim():
+                    break
+                continue # A waiter took over a stale lock here before we could claim it.
+            stale = self.get_stale_owner()
+            if stale is not None and self.take_over(stale):
+                break
+            if not waited:
+                log.info('Waiting for "{}", held by {}.'.format(self.lockdir, self.read_owner() or 'someone'))
+                waited = True
+            if self.timeout is not None and time.time() - start > self.timeout:
+                raise LockTimeout('Timed out after {}s waiting for "{}".'.format(self.timeout, self.lockdir))
+            time.sleep(POLL)
+        if waited:
+            log.info('Acquired "{}" after {:.1f}s.'.format(self.lockdir, time.time() - start))
+        self._stop = threading.Event()
+        self._heartbeat = threading.Thread(target=self.beat)
+        self._heartbeat.daemon = True
+        self._heartbeat.start()
+    def claim(self):
+        """Create our owner file, unless there is one already.
+        Return True if we now hold the lock.
+        """
+        tmp = os.path.join(self.lockdir, '{}.{}.{}.{}'.format(OWNER, self.owner['host'], self.owner['pid'],
+            threading.current_thread().ident))
+        try:
+            with open(tmp, 'w') as fp:
+                json.dump(dict(self.owner, time=time.time()), fp)
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return False # The lockdir was just released.
+            raise
+        try:
+            os.link(tmp, os.path.join(self.lockdir, OWNER))
+            return True
+        except OSError as e:
+            # Over NFS, link() can fail after it worked, if the reply is lost.
+            return e.errno != errno.EEXIST and os.stat(tmp).st_nlink == 2
+        finally:
+            os.remove(tmp)
+    def take_over(self, stale):
+        """stale: the owner file content which we judged stale ('' if none).
+        Return True if we now hold the lock.
+        """
+        fn = os.path.join(self.lockdir, OWNER)
+        if stale:
+            aside = '{}.stale.{}.{}.{}'.format(fn, self.owner['host'], self.owner['pid'],
+                    threading.current_thread().ident)
+            try:
+                os.rename(fn, aside)
+            except OSError:
+                return False # Someone else got there first, or it was released.
+            with open(aside) as fp:
+                content = fp.read()
+            if content != stale:
+                # Re-acquired since we looked. Put it back, untouched.
+                try:
+                    os.rename(aside, fn)
+                except OSError:
+                    log.debug('Cannot restore "{}".'.format(fn), exc_info=True)
+                return False
+            os.remove(aside)
+        log.warning('Taking over stale lock "{}", held by {}.'.format(self.lockdir, stale or 'nobody'))
+        return self.claim()
+    def beat(self):
+        fn = os.path.join(self.lockdir, OWNER)
+        interval = min(HEARTBEAT, self.stale_after / 4.0)
+        warned = False
+        while not self._stop.wait(interval):
+            try:
+                os.utime(fn, None)
+            except OSError:
+                # Possibly just for a moment, while a waiter checks the owner file.
+                if not warned:
+                    log.warning('Cannot refresh lock "{}".'.format(self.lockdir))
+                    warned = True
+    def read_owner(self):
+        try:
+            with open(os.path.join(self.lockdir, OWNER)) as fp:
+                return json.load(fp)
+        except (IOError, ValueError):
+            return None
+    def get_stale_owner(self):
+        """Return the content of a stale owner file ('' if a stale lockdir has none),
+        or None if the lock is live.
+        """
+        fn = os.path.join(self.lockdir, OWNER)
+        try:
+            mtime = os.stat(fn).st_mtime
+            with open(fn) as fp:
+                content = fp.read()
+        except (OSError, IOError):
+            # Until the owner file exists, the directory itself is the heartbeat.
+            try:
+                mtime = os.stat(self.lockdir).st_mtime
+            except OSError:
+                return None # Just released.
+            content = ''
+        if time.time() - mtime > self.stale_after:
+            return content
+        try:
+            owner = json.loads(content)
+        except ValueError:
+            return None
+        if owner['host'] == self.owner['host'] and not is_alive(owner['pid']):
+            return content
+        return None
+
+def get_lock(path):
+    """Return a lock on path, for threads, processes and hosts.
+    """
+    return FileLock(path)
@@ -0,0 +1,214 @@
+"""
+Keep the object stores of long-lived workspaces fast.
+
+Over months, repos collect loose objects and many packfiles, and
+without a commit-graph every reachability query ('branch --contains',
+'checkout') parses commits one by one. The full tasks are:
+    prune-loose         drop loose objects which are packed, or unreachable (and old)
+    incremental-repack  roll small packs (and loose objects) into larger ones, geometrically
+    multi-pack-index    one index over all packs
+    commit-graph        an incremental (split) commit-graph
+A cheap 'auto' mode (for right after 'checkout') only packs loose objects
+and extends the indexes, in repos past a threshold. It neither prunes
+(which walks all history) nor rewrites existing packs.
+
+Shared object stores (a worktree central repo, a mirror) are locked,
+as 'checkout' and 'mirror-sync' lock them.
+"""
+from __future__ import absolute_import
+from . import cmds
+from . import refs
+from . import trace
+import os
+import sys
+import time
+
+log = cmds.log
+
+AUTO_LOOSE_ENV = 'PB_GIT_AUTO_LOOSE'
+AUTO_LOOSE = 1000
+AUTO_PACKS_ENV = 'PB_GIT_AUTO_PACKS'
+AUTO_PACKS = 20
+# Like 'git gc', keep recent unreachable objects, which a concurrent process might still use.
+PRUNE_EXPIRE = '2.weeks.ago'
+
+FULL_TASKS = ('prune-loose', 'incremental-repack', 'multi-pack-index', 'commit-graph')
+AUTO_TASKS = ('pack-loose', 'multi-pack-index', 'commit-graph')
+
+def git(gitdir, cmd):
+    return cmds.capture('git --git-dir={} {}'.format(gitdir, cmd), log=cmds.log_info_sys)
+
+def prune_loose(gitdir):
+    git(gitdir, 'prune-packed --quiet')
+    git(gitdir, 'prune --expire={}'.format(PRUNE_EXPIRE))
+
+def pack_loose(gitdir):
+    """Only the loose objects, into one new pack. No history walk.
+    """
+    git(gitdir, 'repack -d -q')
+
+def incremental_repack(gitdir):
+    from . import status
+    if status.get_git_version() >= (2, 33):
+        git(gitdir, 'repack -d -q --geometric=2')
+    else:
+        git(gitdir, 'repack -d -q')
+
+def multi_pack_index(gitdir):
+    git(gitdir, 'multi-pack-index write')
+    git(gitdir, 'multi-pack-index expire')
+
+def commit_graph(gitdir):
+    from . import status
+    options = ' --changed-paths' if status.get_git_version() >= (2, 27) else ''
+    git(gitdir, 'commit-graph write --reachable --split{}'.format(options))
+
+TASKS = {
+    'prune-loose': prune_loose,
+    'pack-loose': pack_loose,
+    'incremental-repack': incremental_repack,
+    'multi-pack-index': multi_pack_index,
+    'commit-graph': commit_graph,
+}
+
+def parse_count_objects(out):
+    """Return dict of ints.
+    >>> sorted(parse_count_objects('count: 12\\nsize: 48\\nin-pack: 30\\npacks: 2\\nsize-pack: 9\\n').items())
+    [('count', 12), ('in-pack', 30), ('packs', 2), ('size', 48), ('size-pack', 9)]
+    """
+    counts = dict()
+    for line in out.splitlines():
+        key, _, val = line.partition(':')
+        if val.strip().isdigit():
+            counts[key.strip()] = int(val)
+    return counts
+
+def count_objects(gitdir):
+    out, _ = cmds.capture('git --git-dir={} count-objects -v'.format(gitdir), log=cmds.log_debug_sys)
+    return parse_count_objects(out)
+
+def is_due(counts, loose=None, packs=None):
+    """Has the repo passed a threshold for the cheap mode?
+    >>> is_due(dict(count=5, packs=1)), is_due(dict(count=5000, packs=1)), is_due(dict(count=0, packs=30))
+    (False, True, True)
+    """
+    if loose is None:
+        loose = int(os.environ.get(AUTO_LOOSE_ENV, AUTO_LOOSE))
+    if packs is None:
+        packs = int(os.environ.get(AUTO_PACKS_ENV, AUTO_PACKS))
+    return counts.get('count', 0) >= loose or counts.get('packs', 0) >= packs
+
+def probe(gitdir, sha1):
+    """Return the seconds for a 'for-each-ref --contains' query (the kind 'verify'
+    falls back on, when sha1 is not at a branch tip), or None if sha1 is not here.
+    """
+    if not sha1 or not cmds.has_commit(gitdir, sha1):
+        return None
+    start = time.time()
+    cmds.capture('git --git-dir={} for-each-ref --contains {} refs/remotes refs/heads'.format(gitdir, sha1),
+            log=cmds.log_debug_sys)
+    return time.time() - start
+
+def get_objects_size(gitdir):
+    from . import cache
+    return cache.du(os.path.join(gitdir, 'objects'))
+
+def maintain_repo(gitdir, tasks, sha1=None):
+    """Run tasks on gitdir. Return dict(seconds, size_before, size_after, probe_before, probe_after).
+    """
+    result = dict(size_before=get_objects_size(gitdir), probe_before=probe(gitdir, sha1))
+    start = time.time()
+    for task in tasks:
+        with trace.context(phase=task):
+            TASKS[task](gitdir)
+    result['seconds'] = time.time() - start
+    result.update(size_after=get_objects_size(gitdir), probe_after=probe(gitdir, sha1))
+    return result
+
+def get_targets(repos, mirrors_base=None):
+    """Return list of dict(name, path, gitdir, sha1, shared), one per object store.
+    A worktree is maintained through its central repo.
+    """
+    targets = list()
+    seen = set()
+    def add(name, path, gitdir, sha1, shared):
+        if gitdir in seen:
+            return
+        seen.add(gitdir)
+        targets.append(dict(name=name, path=path, gitdir=gitdir, sha1=sha1, shared=shared))
+    for name, cfg in sorted(repos.iteritems()):
+        try:
+            gitdir = refs.find_git_dir(os.path.join(cmds.getcwd(), cfg['path']))
+        except refs.ResolveError:
+            gitdir = None
+        if gitdir:
+            common = refs.find_common_dir(gitdir)
+            add(name, cfg['path'], common, cfg['sha1'], common != os.path.normpath(gitdir))
+    if mirrors_base and ':' not in mirrors_base:
+        for name, cfg in sorted(repos.iteritems()):
+            mirror = cmds.get_mirror_url(mirrors_base, cfg['path'])
+            if os.path.isdir(mirror):
+                add(name, mirror, os.path.normpath(mirror), cfg['sha1'], True)
+    return targets
+
+def run_targets(targets, tasks, jobs=1, auto=False):
+    """Return list of (target, result); result is None if skipped (auto) or failed.
+    """
+    from . import locks
+    def one(target):
+        with trace.context(repo=target['name'], phase='maintain'):
+            try:
+                if auto and not is_due(count_objects(target['gitdir'])):
+                    return target, None
+                if target['shared']:
+                    with locks.get_lock(target['gitdir']):
+                        return target, maintain_repo(target['gitdir'], tasks, target['sha1'])
+                return target, maintain_repo(target['gitdir'], tasks, target['sha1'])
+            except Exception:
+                log.debug('Maintenance failure.', exc_info=True)
+                log.warning('Failed to maintain "{}".'.format(target['path']))
+                return target, None
+    return cmds.parallel_map(one, targets, jobs)
+
+def auto(repos, jobs=1):
+    """The cheap mode, for repos past a threshold. Never raises.
+    """
+    done = [(t, r) for t, r in run_targets(get_targets(repos), AUTO_TASKS, jobs, auto=True) if r]
+    for target, result in done:
+        log.info('Maintained "{}" in {:.1f}s, saving {} bytes.'.format(
+            target['path'], result['seconds'], result['size_before'] - result['size_after']))
+    return done
+
+def format_results(results):
+    def ms(seconds):
+        return '-' if seconds is None else '{:.0f}'.format(seconds * 1000)
+    lines = ['{:>8} {:>12} {:>12} {:>8} {:>8} {}'.format('SECONDS', 'SIZE', 'SAVED', 'MS-PRE', 'MS-POST', 'PATH')]
+    total = 0
+    for target, r in results:
+        if r is None:
+            lines.append('{:>8} {:>12} {:>12} {:>8} {:>8} {}'.format('failed', '-', '-', '-', '-', target['path']))
+            continue
+        saved = r['size_before'] - r['size_after']
+        total += saved
+        lines.append('{:>8.1f} {:>12} {:>12} {:>8} {:>8} {}'.format(r['seconds'], r['size_after'], saved,
+            ms(r['probe_before']), ms(r['probe_after']), target['path']))
+    lines.append('{:>8} {:>12} {:>12} saved in total ({} repos)'.format('', '', total, len(results)))
+    return '\n'.join(lines) + '\n'
+
+def maintain(args):
+    """Maintain every repo in the ini files, and the mirror tree (if local).
+    Print seconds taken, the object store size and bytes saved, and the time
+    (in ms) of a 'for-each-ref --contains' query before and after.
+    """
+    cmds.init(args)
+    from . import mirrors
+    tasks = AUTO_TASKS if args.auto else FULL_TASKS
+    with cmds.cd(args.directory):
+        # Only an explicit, local mirror tree. No need to probe a remote one.
+        mirrors_base = mirrors.get_local_base(args.mirrors)
+        repos = cmds.read_modules(args)
+        targets = get_targets(repos, mirrors_base)
+        results = run_targets(targets, tasks, args.jobs, args.auto)
+    if args.auto:
+        results = [(t, r) for t, r in results if r]
+    sys.stdout.write(format_results(results))
@@ -0,0 +1,257 @@
+"""
+Choose the default mirrors base, lazily.
+
+Probing a remote mirror costs up to PROBE_TIMEOUT seconds, so we do it
+only for commands which use the mirror, and at most once per PROBE_TTL
+seconds. A probe never disables the mirror. Its result goes into the
+health statistics of the remote (see remotes.py), which decide per
+checkout whether the mirror or the origin goes first.
+
+'pb-git mirror-sync' builds and refreshes a directory-style mirror
+itself, in the ext/pi layout of cmds.get_mirror_dir().
+"""
+from __future__ import absolute_import
+from . import cmds
+from . import os as pbos
+from . import trace
+import json
+import os
+import shutil
+import sys
+import time
+import warnings
+
+log = cmds.log
+
+PB_GIT_DEFAULT_MIRRORS_BASE_DEFAULT = '/lustre/hpcprod/cdunn/git-mirrors-client/smrtanalysis/bioinformatics'
+PB_GIT_DEFAULT_MIRRORS_BASE_DEFAULT = 'git://gitmirror.nanofluidics.com'
+MIRRORS_BASE_ENV = 'PB_GIT_DEFAULT_MIRRORS_BASE'
+PROBE_TTL_ENV = 'PB_GIT_MIRROR_PROBE_TTL'
+PROBE_TTL = 300
+PROBE_TIMEOUT = 2
+
+def get_probe_fn():
+    return os.path.join(cmds.get_state_dir(), 'mirror-probe.json')
+
+def read_probes():
+    try:
+        with open(get_probe_fn()) as fp:
+            return json.load(fp)
+    except (IOError, ValueError):
+        return dict()
+
+def write_probes(probes):
+    fn = get_probe_fn()
+    cmds.mkdirs(os.path.dirname(fn))
+    tmp = '{}.{}.tmp'.format(fn, os.getpid())
+    with open(tmp, 'w') as fp:
+        json.dump(probes, fp, indent=2, sort_keys=True)
+    os.rename(tmp, fn)
+
+def probe(base):
+    """Return True if a repo is reachable under base.
+    """
+    return not pbos.system('git ls-remote --heads {}/pith > /dev/null 2>&1'.format(base), timeout=PROBE_TIMEOUT)
+
+def is_reachable(base, ttl=None):
+    """Like probe(), but cached on disk for ttl seconds.
+    A fresh probe is recorded in the stats of the remote.
+    """
+    if ttl is None:
+        ttl = int(os.environ.get(PROBE_TTL_ENV, PROBE_TTL))
+    now = time.time()
+    probes = read_probes()
+    prev = probes.get(base)
+    if prev and 0 <= now - prev['time'] < ttl:
+        log.debug('Mirror probe for {!r} is cached: {!r}'.format(base, prev))
+        return prev['ok']
+    ok = probe(base)
+    if ':' in base:
+        # Untimed: a probe is no checkout. (A local base is a tree, not a server.)
+        from . import remotes
+        remotes.record(base + '/pith', None, ok)
+    probes[base] = dict(time=now, ok=ok)
+    try:
+        write_probes(probes)
+    except Exception:
+        log.debug('Cannot cache mirror probe.', exc_info=True)
+    return ok
+
+def get_default_mirrors_base():
+    base = os.environ.get(MIRRORS_BASE_ENV, PB_GIT_DEFAULT_MIRRORS_BASE_DEFAULT)
+    # '' => do not use a mirror.
+    # In case we use a directory:
+    if base and (':' not in base) and (os.path.abspath(base) in os.path.abspath(os.getcwd())):
+        warnings.warn('Cannot use base above cwd. Ignoring. ({!r} is in {!r})'.format(base, os.getcwd()))
+        base = ''
+    # Keep it either way. Each checkout chooses by the health of the remote.
+    if base and not is_reachable(base):
+        warnings.warn('Git mirrors base is unreachable now. Using it anyway, as its health allows. ({!r})'.format(base))
+    return get_local_base(base) or base
+
+def get_local_base(mirrors):
+    """Return mirrors as an absolute directory, or '' if unset or remote.
+    A relative directory is relative to --directory, so call this inside
+    cd(args.directory), as checkout, maintain and mirror-sync all do.
+    """
+    if not mirrors or ':' in mirrors:
+        return ''
+    return os.path.abspath(mirrors)
+
+def resolve(mirrors):
+    """None => the default, which we probe only now.
+    Call this inside cd(args.directory), for get_local_base().
+    """
+    if mirrors is not None:
+        return get_local_base(mirrors) or mirrors
+    try:
+        return get_default_mirrors_base()
+    except Exception:
+        # To be as robust as possible.
+        log.debug('Cannot get default mirrors base.', exc_info=True)
+        return ''
+
+SYNC_META = 'pb-git-mirror.json'
+# Commits which the ini files need are kept reachable by these branches,
+# so that ordinary clones and fetches from the mirror get them.
+NEEDED_PREFIX = 'refs/heads/pb-git/'
+
+def read_sync_meta(mirror):
+    try:
+        with open(os.path.join(mirror, SYNC_META)) as fp:
+            return json.load(fp)
+    except (IOError, ValueError):
+        return dict()
+
+def write_sync_meta(mirror, meta):
+    fn = os.path.join(mirror, SYNC_META)
+    tmp = '{}.{}.tmp'.format(fn, os.getpid())
+    with open(tmp, 'w') as fp:
+        json.dump(meta, fp, indent=2, sort_keys=True)
+    os.rename(tmp, fn)
+
+def create_mirror(mirror, url, full):
+    """Clone everything if full, else make an empty mirror to fetch into.
+    """
+    cmds.mkdirs(os.path.dirname(mirror))
+    tmp = '{}.{}.tmp'.format(mirror, os.getpid())
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    if full:
+        cmds.capture('git clone --mirror --quiet {} {}'.format(url, tmp), log=cmds.log_info_sys)
+    else:
+        cmds.capture('git init --quiet --bare {}'.format(tmp), log=cmds.log_debug_sys)
+        cmds.capture('git --git-dir={} remote add --mirror=fetch origin {}'.format(tmp, url), log=cmds.log_debug_sys)
+    # So clients may fetch a single SHA1 (checkout --fetch sha1).
+    cmds.capture('git --git-dir={} config uploadpack.allowAnySHA1InWant true'.format(tmp), log=cmds.log_debug_sys)
+    os.rename(tmp, mirror)
+
+def keep_needed(mirror, sha1):
+    """Fetch sha1 from the origin unless we have it, and keep it reachable.
+    If the server refuses to send it alone, fetch everything.
+    """
+    ref = NEEDED_PREFIX + sha1
+    if not cmds.has_commit(mirror, sha1):
+        try:
+            cmds.capture('git --git-dir={} fetch --quiet origin {}:{}'.format(mirror, sha1, ref), log=cmds.log_info_sys)
+            return
+        except IOError:
+            log.warning('Origin of "{}" refused to send {} alone. Fetching everything.'.format(mirror, sha1))
+            cmds.capture('git --git-dir={} fetch --quiet origin'.format(mirror), log=cmds.log_info_sys)
+    cmds.capture('git --git-dir={} update-ref {} {}'.format(mirror, ref, sha1), log=cmds.log_debug_sys)
+
+def update_pins(pins, workspace, sha1):
+    """pins: dict(workspace: sha1), updated in place.
+    Return the sha1s which no workspace needs any more.
+    Workspaces which are gone need nothing.
+    >>> pins = {'/': '1', '.': '1', '/no/such/ws': '2'}
+    >>> update_pins(pins, '/', '3'), update_pins(pins, '.', '3'), sorted(pins.items())
+    (['2'], ['1'], [('.', '3'), ('/', '3')])
+    """
+    old = set(pins.values())
+    pins[workspace] = sha1
+    for ws in list(pins):
+        if ws != workspace and not os.path.isdir(ws):
+            del pins[ws]
+    return sorted(old - set(pins.values()))
+
+def fetch_all(mirror):
+    """Fetch and prune every ref, except our own branches, which the origin lacks.
+    """
+    from . import status
+    if status.get_git_version() >= (2, 29):
+        cmds.capture("git --git-dir={} fetch --quiet --prune origin '+refs/*:refs/*' '^{}*'".format(mirror, NEEDED_PREFIX),
+                log=cmds.log_info_sys)
+        return
+    # Without negative refspecs, --prune drops our branches too. Restore them at once (under the lock).
+    out, _ = cmds.capture("git --git-dir={} for-each-ref --format='%(objectname) %(refname)' {}".format(mirror, NEEDED_PREFIX),
+            log=cmds.log_debug_sys)
+    cmds.capture('git --git-dir={} fetch --quiet --prune origin'.format(mirror), log=cmds.log_info_sys)
+    for line in out.splitlines():
+        sha1, ref = line.split()
+        cmds.capture('git --git-dir={} update-ref {} {}'.format(mirror, ref, sha1), log=cmds.log_debug_sys)
+
+def sync_repo(mirror, url, sha1, needed_only=False, workspace=None):
+    """Create or update one mirror repo, incrementally.
+    With needed_only, fetch only sha1 (if missing), not every branch.
+    Each workspace (default: cwd) pins one sha1. Other workspaces sharing
+    the mirror keep theirs.
+    Return the new sync metadata.
+    """
+    from . import locks
+    if workspace is None:
+        workspace = cmds.getcwd()
+    with locks.get_lock(mirror):
+        if not os.path.isdir(mirror):
+            create_mirror(mirror, url, full=not needed_only)
+        else:
+            cmds.capture('git --git-dir={} remote set-url origin {}'.format(mirror, url), log=cmds.log_debug_sys)
+            if not needed_only:
+                fetch_all(mirror)
+        keep_needed(mirror, sha1)
+        meta = read_sync_meta(mirror)
+        for unneeded in update_pins(meta.setdefault('pins', dict()), workspace, sha1):
+            cmds.capture('git --git-dir={} update-ref -d {}{}'.format(mirror, NEEDED_PREFIX, unneeded),
+                    log=cmds.log_debug_sys)
+        now = time.time()
+        if not needed_only:
+            meta['synced'] = now
+            try:
+                meta['head'] = cmds.capture('git --git-dir={} rev-parse HEAD'.format(mirror), log=cmds.log_debug_sys)[0].strip()
+            except IOError:
+                meta['head'] = None # e.g. an empty remote
+        meta.update(url=url, needed=sha1, needed_synced=now)
+        write_sync_meta(mirror, meta)
+    return meta
+
+def format_sync(results):
+    """results: [(path, meta)]
+    """
+    def when(t):
+        return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(t)) if t else '-' * 19
+    lines = list()
+    for path, meta in sorted(results):
+        lines.append('{} {} {} {}'.format(when(meta.get('synced')), (meta.get('head') or '-')[:12],
+            meta['needed'][:12], path))
+    return '\n'.join(lines) + '\n' if lines else ''
+
+def sync(args):
+    """Build or refresh the directory mirror for every repo in the ini files.
+    """
+    cmds.init(args)
+    with cmds.cd(args.directory):
+        mirrors_base = get_local_base(args.mirrors)
+        if not mirrors_base:
+            raise Exception('mirror-sync needs a local directory for --mirrors, not {!r}.'.format(args.mirrors))
+        repos = cmds.read_modules(args)
+        def sync_one(item):
+            name, cfg = item
+            if 'nanofluidics' in cfg['url']:
+                log.info('{} is already local. Not mirrored.'.format(name))
+                return None
+            mirror = cmds.get_mirror_url(mirrors_base, cfg['path'])
+            with trace.context(repo=name, phase='fetch'):
+                meta = sync_repo(mirror, cfg['url'], cfg['sha1'], args.needed)
+            return (cfg['path'], meta)
+        results = cmds.parallel_map(sync_one, sorted(repos.iteritems()), args.jobs)
+    sys.stdout.write(format_sync([r for r in results if r]))
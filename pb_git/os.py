@@ -1,18 +1,23 @@
 from __future__ import absolute_import
+from . import trace
 import os
 
-_timeout_exists = None
+def which(exe):
+    """Return full path to exe on PATH, or None.
+    """
+    for d in os.environ.get('PATH', '').split(os.pathsep):
+        fn = os.path.join(d, exe)
+        if os.path.isfile(fn) and os.access(fn, os.X_OK):
+            return fn
+    return None
 
 def system(call, timeout=None):
     """With timeout, if available.
     """
-    global _timeout_exists
-    if _timeout_exists is None:
-        rc = os.system('timeout 1 true')
-        _timeout_exists = not rc
-    if timeout and _timeout_exists:
+    if timeout and which('timeout'):
         call = 'timeout {} {}'.format(timeout, call)
-    rc = os.system(call)
+    returncode, _, _ = trace.run(call, shell=True, stdout=None, stderr=None)
+    rc = trace.wait_status(returncode)
     if rc:
         print '{} <- "{}"'.format(rc, call)
     return rc
@@ -0,0 +1,118 @@
+"""
+Plan a checkout without the network.
+
+For each repo, one 'git cat-file --batch-check' process tells us whether
+the wanted commit is already in the object store, without ever fetching.
+That is one object per repo: submodules follow their branches (--remote),
+not the gitlinks at that commit, and keep their own object stores, so
+the parent has nothing more to check. Each repo is then:
+    up-to-date      HEAD is already the wanted SHA1
+    checkout-only   every wanted commit is here
+    fetch-needed    the repo exists, but lacks a wanted commit
+    clone-needed    no repo yet
+so that 'checkout' can start the network work first, and fetch before
+checking out instead of after a failed checkout.
+"""
+from __future__ import absolute_import
+from . import cmds
+from . import refs
+from . import trace
+import json
+import os
+import sys
+
+log = cmds.log
+
+UP_TO_DATE = 'up-to-date'
+CHECKOUT_ONLY = 'checkout-only'
+FETCH_NEEDED = 'fetch-needed'
+CLONE_NEEDED = 'clone-needed'
+NETWORK = (FETCH_NEEDED, CLONE_NEEDED)
+
+def parse_batch_check(out):
+    """Return set of names which are missing.
+    >>> sorted(parse_batch_check('abc commit 230\\ndef missing\\n'))
+    ['def']
+    """
+    missing = set()
+    for line in out.splitlines():
+        parts = line.split()
+        if len(parts) == 2 and parts[1] == 'missing':
+            missing.add(parts[0])
+    return missing
+
+def find_missing(gitdir, sha1s):
+    """Return the subset of sha1s not in gitdir, with one process.
+    Never fetch, even in a partial clone.
+    """
+    call = 'git cat-file --batch-check'
+    cmds.log_debug_sys('`{}` in {}'.format(call, gitdir))
+    env = cmds.get_no_lazy_fetch_env(gitdir)
+    returncode, out, err = trace.run(call, env=env, cwd=cmds.getcwd(), input=''.join(s + '\n' for s in sha1s))
+    if returncode:
+        raise IOError(err)
+    return parse_batch_check(out)
+
+def get_wanted(cfg):
+    """Only the commit itself. (See the module docstring for submodules.)
+    find_missing() takes a list, in case a plan ever needs more.
+    """
+    return [cfg['sha1']]
+
+def get_object_dir(cfg, opts):
+    """Return the gitdir which holds the objects for cfg, or None.
+    """
+    if opts.get('worktrees'):
+        from . import worktree
+        central = worktree.get_central(opts['worktrees'], cfg['url'])
+        return central if os.path.isdir(central) else None
+    try:
+        gitdir = refs.find_git_dir(os.path.join(cmds.getcwd(), cfg['path']))
+    except refs.ResolveError:
+        return None
+    return gitdir
+
+def plan_repo(cfg, opts=None):
+    """Return one of UP_TO_DATE, CHECKOUT_ONLY, FETCH_NEEDED, CLONE_NEEDED.
+    """
+    opts = opts or dict()
+    path = cfg['path']
+    if cmds.is_repo(path) and cmds.get_sha1(path) == cfg['sha1']:
+        return UP_TO_DATE
+    gitdir = get_object_dir(cfg, opts)
+    if not gitdir:
+        return CLONE_NEEDED
+    try:
+        missing = find_missing(gitdir, get_wanted(cfg))
+    except IOError:
+        log.debug('Cannot check objects in {!r}.'.format(gitdir), exc_info=True)
+        return FETCH_NEEDED
+    if missing:
+        return FETCH_NEEDED
+    return CHECKOUT_ONLY
+
+def plan_repos(items, opts, jobs=1):
+    """items: [(name, cfg)]
+    Return dict(name: plan).
+    """
+    def plan_one(item):
+        name, cfg = item
+        with trace.context(repo=name, phase='plan'):
+            return name, plan_repo(cfg, opts)
+    return dict(cmds.parallel_map(plan_one, items, jobs))
+
+def plan(args):
+    """Print the plan for every repo, as a table or JSON.
+    """
+    cmds.init(args)
+    opts = dict(worktrees=args.worktrees)
+    with cmds.cd(args.directory):
+        repos = cmds.read_modules(args)
+        plans = plan_repos(sorted(repos.iteritems()), opts, args.jobs)
+    if args.json:
+        json.dump(dict((name, dict(path=repos[name]['path'], sha1=repos[name]['sha1'], plan=p))
+            for name, p in plans.iteritems()), sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        for name, p in sorted(plans.iteritems()):
+            sys.stdout.write('{:13} {} {}\n'.format(p, repos[name]['sha1'], repos[name]['path']))
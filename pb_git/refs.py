@@ -0,0 +1,96 @@
+"""
+Resolve HEAD without running git.
+
+This reads .git/HEAD, loose refs and packed-refs directly, following
+a gitfile ("gitdir: ...") and the "commondir" of a linked worktree.
+Anything unusual raises ResolveError, so callers can fall back on git.
+"""
+from __future__ import absolute_import
+import os
+import re
+
+re_sha1 = re.compile(r'^[0-9a-f]{40}$|^[0-9a-f]{64}$')
+
+# These live in the per-worktree gitdir, not in the commondir.
+PER_WORKTREE = ('HEAD', 'refs/bisect/', 'refs/worktree/', 'refs/rewritten/')
+
+class ResolveError(Exception):
+    """We cannot resolve this in pure python. Ask git.
+    """
+
+def read_file(fn):
+    with open(fn) as fp:
+        return fp.read().strip()
+
+def find_git_dir(path):
+    """Return the gitdir of the working-tree at path, or None.
+    Follow a gitfile, as used by submodules and worktrees.
+    """
+    dotgit = os.path.join(path, '.git')
+    if os.path.isdir(dotgit):
+        return dotgit
+    if not os.path.isfile(dotgit):
+        return None
+    content = read_file(dotgit)
+    if not content.startswith('gitdir:'):
+        raise ResolveError('Bad gitfile {!r}: {!r}'.format(dotgit, content))
+    gitdir = content[len('gitdir:'):].strip()
+    return os.path.normpath(os.path.join(path, gitdir))
+
+def find_common_dir(gitdir):
+    """For a linked worktree, most refs are in the main repo.
+    """
+    fn = os.path.join(gitdir, 'commondir')
+    if not os.path.exists(fn):
+        return gitdir
+    return os.path.normpath(os.path.join(gitdir, read_file(fn)))
+
+def read_packed_refs(commondir):
+    """Return dict(refname: sha1).
+    """
+    refs = dict()
+    fn = os.path.join(commondir, 'packed-refs')
+    if not os.path.exists(fn):
+        return refs
+    with open(fn) as fp:
+        for line in fp:
+            if line.startswith('#') or line.startswith('^'):
+                continue
+            parts = line.split()
+            if len(parts) == 2:
+                refs[parts[1]] = parts[0]
+    return refs
+
+def resolve_ref(gitdir, ref, depth=5):
+    """Return sha1 for ref (e.g. 'HEAD', 'refs/heads/master').
+    """
+    if depth <= 0:
+        raise ResolveError('Too many levels of symbolic refs at {!r}'.format(ref))
+    if ref.startswith(PER_WORKTREE):
+        refdir = gitdir
+    else:
+        refdir = find_common_dir(gitdir)
+    fn = os.path.join(refdir, ref)
+    if os.path.isfile(fn):
+        content = read_file(fn)
+        if content.startswith('ref:'):
+            return resolve_ref(gitdir, content[len('ref:'):].strip(), depth-1)
+        if re_sha1.match(content):
+            return content
+        raise ResolveError('Unexpected content in {!r}: {!r}'.format(fn, content))
+    packed = read_packed_refs(find_common_dir(gitdir))
+    if ref in packed:
+        return packed[ref]
+    raise ResolveError('Cannot find ref {!r} in {!r}'.format(ref, gitdir))
+
+def read_head(path):
+    """Return sha1 of HEAD for the working-tree at path.
+    Raise ResolveError if we cannot.
+    """
+    gitdir = find_git_dir(path)
+    if not gitdir:
+        raise ResolveError('No git repo at {!r}'.format(path))
+    try:
+        return resolve_ref(gitdir, 'HEAD')
+    except (IOError, OSError) as e:
+        raise ResolveError(str(e))
@@ -0,0 +1,281 @@
+"""
+Choose between the mirror and the origin by their track record.
+
+For each remote server (the host of a URL, or the directory of a local
+mirror), we keep statistics in the state dir: attempts, failures,
+failures in a row, and moving averages of the seconds a successful
+checkout took, overall and per repo. After FAILURE_LIMIT failures in a
+row, a remote is unhealthy for RETRY_AFTER seconds. Otherwise, the
+fastest for the repo goes first. Only transport errors count as failures:
+a mirror which lacks a repo or a commit is just behind, not unhealthy.
+A probe of the mirror (see mirrors.py) counts too, but has no timing.
+
+A fresh clone can also race both remotes, and cancel the loser.
+"""
+from __future__ import absolute_import
+from . import cmds
+from . import trace
+import json
+import os
+import re
+import shutil
+import sys
+import threading
+import time
+
+log = cmds.log
+
+EWMA_ALPHA = 0.3
+FAILURE_LIMIT = 3
+RETRY_AFTER = 600
+
+# What git says when it cannot talk to the server at all.
+TRANSPORT_ERRORS = re.compile('|'.join([
+    r'Could not resolve host',
+    r'Connection refused',
+    r'Connection reset',
+    r'timed out',
+    r'Network is unreachable',
+    r'No route to host',
+    r'unable to access',
+    r'Could not read from remote repository',
+    r'the remote end hung up unexpectedly',
+    r'early EOF',
+]))
+
+_stats = None
+_lock = threading.Lock()
+
+def get_stats_fn():
+    return os.path.join(cmds.get_state_dir(), 'remotes.json')
+
+def get_key(url):
+    """Stats are per server, not per repo.
+    >>> get_key('git@github.com:PacBio/Foo.git')
+    'github.com'
+    >>> get_key('git://gitmirror.nanofluidics.com/ext/pi/pith')
+    'gitmirror.nanofluidics.com'
+    >>> get_key('/mirrors/ext/pi/pith')
+    '/mirrors/ext/pi'
+    """
+    from . import cache
+    normalized = cache.normalize_url(url)
+    if normalized.startswith('/'):
+        return os.path.dirname(normalized)
+    return normalized.split('/')[0]
+
+def read_stats():
+    """Return dict(key: stat), read once per process.
+    """
+    global _stats
+    if _stats is None:
+        try:
+            with open(get_stats_fn()) as fp:
+                _stats = json.load(fp)
+        except (IOError, ValueError):
+            _stats = dict()
+    return _stats
+
+def write_stats(stats):
+    fn = get_stats_fn()
+    cmds.mkdirs(os.path.dirname(fn))
+    tmp = '{}.{}.{}.tmp'.format(fn, os.getpid(), threading.current_thread().ident)
+    with open(tmp, 'w') as fp:
+        json.dump(stats, fp, indent=2, sort_keys=True)
+    os.rename(tmp, fn)
+
+def average(prev, seconds):
+    if prev is None:
+        return seconds
+    return EWMA_ALPHA * seconds + (1 - EWMA_ALPHA) * prev
+
+def update(stat, seconds, ok, now, repo=None):
+    """seconds: None for an untimed attempt (a probe).
+    >>> stat = update(None, 10.0, True, 100, 'pith')
+    >>> stat = update(stat, 20.0, True, 101)
+    >>> stat['seconds'], stat['attempts'], stat['repos']
+    (13.0, 2, {'pith': 10.0})
+    >>> stat = update(stat, 5.0, False, 102)
+    >>> stat['seconds'], stat['failures'], stat['in_a_row']
+    (13.0, 1, 1)
+    >>> stat = update(stat, None, True, 103)
+    >>> stat['seconds'], stat['in_a_row']
+    (13.0, 0)
+    """
+    stat = dict(stat or dict(attempts=0, failures=0, in_a_row=0, seconds=None, last=None, last_failure=None))
+    stat['repos'] = dict(stat.get('repos') or dict())
+    stat['attempts'] += 1
+    stat['last'] = now
+    if ok:
+        stat['in_a_row'] = 0
+        if seconds is not None:
+            stat['seconds'] = average(stat['seconds'], seconds)
+            if repo:
+                stat['repos'][repo] = average(stat['repos'].get(repo), seconds)
+    else:
+        stat['failures'] += 1
+        stat['in_a_row'] += 1
+        stat['last_failure'] = now
+    return stat
+
+def is_transport_error(err):
+    """
+    >>> is_transport_error("fatal: unable to access 'https://github.com/x/': Could not resolve host: github.com")
+    True
+    >>> is_transport_error("fatal: reference is not a tree: 0123")
+    False
+    >>> is_transport_error("fatal: repository '/mirrors/ext/pi/x' does not exist")
+    False
+    """
+    return bool(TRANSPORT_ERRORS.search(err or ''))
+
+def record(url, seconds, ok, repo=None):
+    """repo: the path of the repo in the workspace, for per-repo timings.
+    """
+    key = get_key(url)
+    with _lock:
+        stats = read_stats()
+        stats[key] = update(stats.get(key), seconds, ok, time.time(), repo)
+        try:
+            write_stats(stats)
+        except Exception:
+            log.debug('Cannot save remote stats.', exc_info=True)
+
+def is_healthy(stat, now):
+    """
+    >>> is_healthy(None, 0)
+    True
+    >>> is_healthy(dict(in_a_row=3, last_failure=100), 200)
+    False
+    >>> is_healthy(dict(in_a_row=3, last_failure=100), 100 + RETRY_AFTER + 1)
+    True
+    """
+    if not stat or stat['in_a_row'] < FAILURE_LIMIT:
+        return True
+    return now - stat['last_failure'] > RETRY_AFTER
+
+def rank(sources, stats, now, repo=None):
+    """Healthy before unhealthy, then fastest first.
+    Compare the timings of this repo, if every remote has them. Otherwise,
+    the averages over all repos, if every remote has those. Otherwise,
+    keep the given order (mirror first).
+    sources: [(remote, url)]
+    >>> stats = {'github.com': dict(in_a_row=0, seconds=5.0), 'mirror.com': dict(in_a_row=0, seconds=9.0)}
+    >>> rank([('mirror', 'git://mirror.com/pith'), ('origin', 'git@github.com:PacBio/pith')], stats, 0)
+    [('origin', 'git@github.com:PacBio/pith'), ('mirror', 'git://mirror.com/pith')]
+    >>> rank([('mirror', 'git://mirror.com/pith'), ('origin', 'git://new.com/pith')], stats, 0)
+    [('mirror', 'git://mirror.com/pith'), ('origin', 'git://new.com/pith')]
+    >>> stats['mirror.com'].update(repos=dict(pith=1.0))
+    >>> stats['github.com'].update(repos=dict(pith=2.0))
+    >>> rank([('origin', 'git@github.com:PacBio/pith'), ('mirror', 'git://mirror.com/pith')], stats, 0, 'pith')
+    [('mirror', 'git://mirror.com/pith'), ('origin', 'git@github.com:PacBio/pith')]
+    >>> stats['github.com'].update(in_a_row=FAILURE_LIMIT, last_failure=0)
+    >>> rank([('origin', 'git@github.com:PacBio/pith'), ('mirror', 'git://mirror.com/pith')], stats, 1)
+    [('mirror', 'git://mirror.com/pith'), ('origin', 'git@github.com:PacBio/pith')]
+    """
+    found = [stats.get(get_key(url)) or dict() for _, url in sources]
+    if repo and all(repo in (stat.get('repos') or dict()) for stat in found):
+        timing = lambda stat: stat['repos'][repo]
+    elif all(stat.get('seconds') is not None for stat in found):
+        timing = lambda stat: stat['seconds']
+    else:
+        timing = lambda stat: 0.0
+    def key(source):
+        stat = stats.get(get_key(source[1]))
+        return (not is_healthy(stat, now), timing(stat) if stat else 0.0)
+    return sorted(sources, key=key)
+
+def order(sources, repo=None):
+    """Return sources, best first.
+    """
+    with _lock:
+        stats = dict(read_stats())
+    ordered = rank(sources, stats, time.time(), repo)
+    if ordered != list(sources):
+        log.debug('Remote order: {!r}'.format([remote for remote, _ in ordered]))
+    return ordered
+
+def is_replaceable(dest):
+    """May a clone replace whatever is at dest?
+    Only if nothing is there, or an interrupted clone (.git without a config).
+    """
+    if not os.path.exists(dest):
+        return True
+    if not os.path.isdir(dest) or os.path.islink(dest):
+        return False
+    names = os.listdir(dest)
+    return not names or (names == ['.git'] and not os.path.exists(os.path.join(dest, '.git', 'config')))
+
+def race_clone(sources, path, options=''):
+    """Clone from every source at once. Keep the first to finish,
+    and cancel the others.
+    Return (remote, url) of the winner. Raise if all fail.
+    """
+    dest = os.path.join(cmds.getcwd(), path)
+    if not is_replaceable(dest):
+        raise Exception('"{}" exists, and is not a clone. Not replacing it.'.format(path))
+    lock = threading.Lock()
+    state = dict(winner=None, procs=dict())
+    def attempt(remote, url):
+        tmp = '{}.{}.race'.format(dest, remote)
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        call = 'git clone --quiet{} --origin {} {} {}'.format(options, remote, url, tmp)
+        cmds.log_info_sys(call)
+        def on_start(proc):
+            with lock:
+                state['procs'][remote] = proc
+                if state['winner']:
+                    proc.terminate()
+        start = time.time()
+        returncode, _, err = trace.run(call, on_start=on_start)
+        with lock:
+            won = not returncode and not state['winner']
+            if won:
+                state['winner'] = (remote, url, tmp)
+                for other, proc in state['procs'].items():
+                    if other != remote and proc.poll() is None:
+                        proc.terminate()
+            cancelled = bool(returncode) and state['winner'] is not None
+        if not returncode:
+            record(url, time.time() - start, True, path)
+        elif cancelled:
+            log.info('Cancelled clone from "{}" (lost the race).'.format(url))
+        else:
+            if is_transport_error(err):
+                record(url, time.time() - start, False)
+            log.warning('Failed to clone "{}" from "{}":\n{}'.format(path, url, err.strip()))
+    threads = [threading.Thread(target=attempt, args=source) for source in sources]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    for remote, url in sources:
+        tmp = '{}.{}.race'.format(dest, remote)
+        if not state['winner'] or tmp != state['winner'][2]:
+            shutil.rmtree(tmp, ignore_errors=True)
+    if not state['winner']:
+        raise Exception('Cannot clone "{}" from any of {!r}.'.format(path, [url for _, url in sources]))
+    remote, url, tmp = state['winner']
+    cmds.log_info_mod('Cloned "{}" from {} "{}", which won the race.'.format(path, remote, url))
+    if os.path.exists(dest):
+        if not is_replaceable(dest): # Someone put something there meanwhile.
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise Exception('"{}" appeared during the clone. Not replacing it.'.format(path))
+        shutil.rmtree(dest)
+    os.rename(tmp, dest)
+    return remote, url
+
+def format_stats(stats, now):
+    lines = ['{:>8} {:>8} {:>6} {:>9}  {:7}  {}'.format('attempts', 'failures', 'in-row', 'avg-secs', 'health', 'remote')]
+    for key, stat in sorted(stats.items()):
+        seconds = '{:9.2f}'.format(stat['seconds']) if stat['seconds'] is not None else '{:>9}'.format('-')
+        lines.append('{:8} {:8} {:6} {}  {:7}  {}'.format(stat['attempts'], stat['failures'], stat['in_a_row'],
+            seconds, 'ok' if is_healthy(stat, now) else 'BAD', key))
+    return '\n'.join(lines) + '\n'
+
+def show(args):
+    """Show the statistics of each remote.
+    """
+    cmds.init(args)
+    sys.stdout.write(format_stats(read_stats(), time.time()))
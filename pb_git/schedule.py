@@ -0,0 +1,110 @@
+"""
+Start the longest repos first.
+
+With several jobs, the wall time is at least that of the slowest repo,
+so it should not start last. We remember how long each repo took
+(per normalized URL, split by phase) in the state dir. A repo with no
+history is estimated from the size of an object store we already have:
+its own, its worktree central repo, its cache entry, or its local mirror.
+"""
+from __future__ import absolute_import
+from . import cmds
+from . import refs
+from . import trace
+import collections
+import json
+import os
+import threading
+
+log = cmds.log
+
+EWMA_ALPHA = 0.5
+# Only the order matters, so this need not be accurate.
+ESTIMATE_BYTES_PER_SECOND = 10 * 2**20
+
+_timings = None
+_lock = threading.Lock()
+
+def get_timings_fn():
+    return os.path.join(cmds.get_state_dir(), 'timings.json')
+
+def read_timings():
+    """Return dict(normalized-url: dict(seconds, phases)), read once per process.
+    """
+    global _timings
+    with _lock:
+        if _timings is None:
+            try:
+                with open(get_timings_fn()) as fp:
+                    _timings = json.load(fp)
+            except (IOError, ValueError):
+                _timings = dict()
+        return _timings
+
+def write_timings():
+    timings = read_timings()
+    fn = get_timings_fn()
+    cmds.mkdirs(os.path.dirname(fn))
+    tmp = '{}.{}.tmp'.format(fn, os.getpid())
+    with _lock:
+        with open(tmp, 'w') as fp:
+            json.dump(timings, fp, indent=2, sort_keys=True)
+    os.rename(tmp, fn)
+
+def get_phases(repo):
+    """Return dict(phase: seconds) of the subprocesses traced for repo.
+    """
+    phases = collections.defaultdict(float)
+    for e in trace.get_events():
+        if e['repo'] == repo:
+            phases[e['phase']] += e['seconds']
+    return dict(phases)
+
+def record(url, seconds, phases):
+    from . import cache
+    key = cache.normalize_url(url)
+    timings = read_timings()
+    with _lock:
+        prev = timings.get(key)
+        if prev:
+            seconds = EWMA_ALPHA * seconds + (1 - EWMA_ALPHA) * prev['seconds']
+        timings[key] = dict(seconds=seconds, phases=phases)
+
+def get_object_stores(cfg, mirrors_base, opts):
+    """Candidates for the size of this repo, best first.
+    """
+    from . import cache
+    stores = list()
+    try:
+        gitdir = refs.find_git_dir(os.path.join(cmds.getcwd(), cfg['path']))
+        if gitdir:
+            stores.append(os.path.join(refs.find_common_dir(gitdir), 'objects'))
+    except refs.ResolveError:
+        pass
+    if opts.get('worktrees'):
+        from . import worktree
+        stores.append(os.path.join(worktree.get_central(opts['worktrees'], cfg['url']), 'objects'))
+    if opts.get('cache_dir'):
+        stores.append(os.path.join(cache.get_entry(opts['cache_dir'], cfg['url']), 'objects'))
+    if mirrors_base and ':' not in mirrors_base:
+        stores.append(os.path.join(cmds.get_mirror_url(mirrors_base, cfg['path']), 'objects'))
+    return stores
+
+def estimate(cfg, mirrors_base, opts):
+    """Return the expected seconds to check out cfg.
+    """
+    from . import cache
+    prev = read_timings().get(cache.normalize_url(cfg['url']))
+    if prev:
+        return prev['seconds']
+    for objects in get_object_stores(cfg, mirrors_base, opts):
+        if os.path.isdir(objects):
+            return float(cache.du(objects)) / ESTIMATE_BYTES_PER_SECOND
+    return 0.0
+
+def longest_first(items, expected):
+    """Stable, so ties keep their order.
+    >>> longest_first(['a', 'b', 'c', 'd'], dict(a=1, b=3, c=0, d=3).get)
+    ['b', 'd', 'a', 'c']
+    """
+    return sorted(items, key=lambda item: -expected(item))
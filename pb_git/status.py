@@ -0,0 +1,116 @@
+"""
+Scan the state of every repo at once: is it dirty, is it off the SHA1
+in its ini, and how many commits would 'prepare' pick up?
+
+One 'git status --porcelain=v2 --branch' per repo, in parallel, with
+the untracked-cache (and fsmonitor, where git has a builtin one).
+"""
+from __future__ import absolute_import
+from . import cmds
+from . import trace
+import json
+import re
+import sys
+import threading
+
+log = cmds.log
+
+_git_version = None
+_git_version_lock = threading.Lock()
+
+def get_git_version():
+    """Return tuple of ints, e.g. (2, 39, 2).
+    """
+    global _git_version
+    with _git_version_lock:
+        if _git_version is None:
+            out, _ = cmds.capture('git --version', log=cmds.log_debug_sys)
+            _git_version = tuple(int(n) for n in re.findall(r'\d+', out)[:3])
+        return _git_version
+
+def get_status_options():
+    """Speed-ups, if git has them. Settings in a repo's own config still win
+    where git honors them.
+    """
+    options = ' -c core.untrackedCache=true'
+    # The builtin fsmonitor daemon exists only on macOS and Windows.
+    if get_git_version() >= (2, 36) and sys.platform in ('darwin', 'win32'):
+        options += ' -c core.fsmonitor=true'
+    return options
+
+def parse_porcelain_v2(out):
+    """Return dict(head, branch, changed, untracked).
+    >>> st = parse_porcelain_v2('# branch.oid abc\\n# branch.head (detached)\\n1 .M N... 100644 100644 100644 a b foo\\n? bar\\n? baz\\n')
+    >>> sorted(st.items())
+    [('branch', None), ('changed', 1), ('head', 'abc'), ('untracked', 2)]
+    """
+    st = dict(head=None, branch=None, changed=0, untracked=0)
+    for line in out.splitlines():
+        if line.startswith('# branch.oid '):
+            oid = line.split()[2]
+            st['head'] = None if oid == '(initial)' else oid
+        elif line.startswith('# branch.head '):
+            head = line.split()[2]
+            st['branch'] = None if head == '(detached)' else head
+        elif line[:2] in ('1 ', '2 ', 'u '):
+            st['changed'] += 1
+        elif line.startswith('? '):
+            st['untracked'] += 1
+    return st
+
+def count_ahead_behind(path, ini_sha1):
+    """Return (commits in HEAD but not ini_sha1, commits in ini_sha1 but not HEAD),
+    or (None, None) if ini_sha1 is not here.
+    """
+    try:
+        out, _ = cmds.capture('git -C {} rev-list --left-right --count {}...HEAD'.format(path, ini_sha1),
+                log=cmds.log_debug_sys)
+    except IOError:
+        return None, None
+    behind, ahead = [int(n) for n in out.split()]
+    return ahead, behind
+
+def get_repo_status(name, cfg):
+    path = cfg['path']
+    st = dict(name=name, path=path, ini=cfg['sha1'], head=None, branch=None, changed=None, untracked=None,
+            ahead=None, behind=None)
+    if not cmds.is_repo(path):
+        st['state'] = 'missing'
+        return st
+    out, _ = cmds.capture('git{} -C {} status --porcelain=v2 --branch'.format(get_status_options(), path),
+            log=cmds.log_debug_sys)
+    st.update(parse_porcelain_v2(out))
+    if st['head'] != st['ini']:
+        st['ahead'], st['behind'] = count_ahead_behind(path, st['ini'])
+        st['state'] = 'off-ini'
+    else:
+        st['ahead'] = st['behind'] = 0
+        st['state'] = 'dirty' if st['changed'] or st['untracked'] else 'clean'
+    return st
+
+def format_table(statuses):
+    def num(n):
+        return '-' if n is None else str(n)
+    rows = [('STATE', 'PATH', 'HEAD', 'INI', 'AHEAD', 'BEHIND', 'CHANGED', 'UNTRACKED', 'BRANCH')]
+    for st in statuses:
+        rows.append((st['state'], st['path'], (st['head'] or '-')[:10], st['ini'][:10],
+            num(st['ahead']), num(st['behind']), num(st['changed']), num(st['untracked']), st['branch'] or '-'))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    return ''.join('  '.join(col.ljust(w) for col, w in zip(row, widths)).rstrip() + '\n' for row in rows)
+
+def status(args):
+    """Print the state of every repo, as a table or JSON.
+    """
+    cmds.init(args)
+    with cmds.cd(args.directory):
+        repos = cmds.read_modules(args)
+        def status_one(item):
+            name, cfg = item
+            with trace.context(repo=name, phase='status'):
+                return get_repo_status(name, cfg)
+        statuses = cmds.parallel_map(status_one, sorted(repos.iteritems()), args.jobs)
+    if args.json:
+        json.dump(statuses, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        sys.stdout.write(format_table(statuses))
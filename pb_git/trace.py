@@ -0,0 +1,167 @@
+"""
+Run subprocesses, and record each one: wall time, exit code, bytes of
+output, and the repo and phase it belongs to.
+
+The record can be written as JSON in the Chrome trace-event format
+(chrome://tracing, or https://ui.perfetto.dev), and summarized per repo
+and per phase.
+"""
+from __future__ import absolute_import
+from contextlib import contextmanager
+import collections
+import json
+import logging
+import os
+import shlex
+import subprocess
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+PHASES = ('clone', 'fetch', 'checkout', 'submodule', 'ls-remote')
+
+_tls = threading.local()
+_lock = threading.Lock()
+_events = list()
+_tids = dict()
+_start = time.time()
+
+@contextmanager
+def context(repo=None, phase=None):
+    """Attribute subprocesses in this thread to repo and/or phase.
+    """
+    prev = (getattr(_tls, 'repo', None), getattr(_tls, 'phase', None))
+    if repo is not None:
+        _tls.repo = repo
+    if phase is not None:
+        _tls.phase = phase
+    try:
+        yield
+    finally:
+        _tls.repo, _tls.phase = prev
+
+def guess_phase(call):
+    """When the context does not say.
+    >>> guess_phase('git -C checkout fetch origin')
+    'fetch'
+    >>> guess_phase('timeout 2 git ls-remote --heads foo')
+    'ls-remote'
+    >>> guess_phase('p4 edit foo.ini')
+    'p4'
+    >>> guess_phase('rm -rf foo')
+    'other'
+    """
+    words = call.split()
+    if words and os.path.basename(words[0]) == 'p4':
+        return 'p4'
+    skip = False
+    for word in words:
+        if skip:
+            skip = False
+        elif word in ('-C', '-c', '--git-dir'):
+            skip = True
+        elif word in PHASES:
+            return word
+    return 'other'
+
+def get_tid():
+    """Small, stable thread-id, for a readable trace.
+    """
+    ident = threading.current_thread().ident
+    with _lock:
+        return _tids.setdefault(ident, len(_tids))
+
+def record(call, start, end, returncode, nbytes):
+    event = dict(
+        call=call,
+        start=start,
+        seconds=end - start,
+        returncode=returncode,
+        bytes=nbytes,
+        repo=getattr(_tls, 'repo', None),
+        phase=getattr(_tls, 'phase', None) or guess_phase(call),
+        tid=get_tid(),
+    )
+    with _lock:
+        _events.append(event)
+    return event
+
+def wait_status(returncode):
+    """Convert a subprocess returncode into an os.system() status.
+    >>> wait_status(1)
+    256
+    >>> wait_status(-9)
+    9
+    """
+    if returncode < 0:
+        return -returncode
+    return returncode << 8
+
+def run(call, shell=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=None, cwd=None, on_start=None, input=None):
+    """Return (returncode, out, err), and record the call.
+    out/err are None unless piped.
+    on_start(proc) lets another thread cancel the call.
+    input (if any) is written to stdin.
+    """
+    args = call if shell else shlex.split(call)
+    start = time.time()
+    stdin = None if input is None else subprocess.PIPE
+    proc = subprocess.Popen(args, shell=shell, stdin=stdin, stdout=stdout, stderr=stderr, env=env, cwd=cwd)
+    if on_start:
+        on_start(proc)
+    out, err = proc.communicate(input)
+    record(call, start, time.time(), proc.returncode, len(out or '') + len(err or ''))
+    return proc.returncode, out, err
+
+def get_events():
+    with _lock:
+        return list(_events)
+
+def as_chrome_trace(events):
+    """Return dict in Chrome trace-event format (complete events, in microseconds).
+    """
+    trace_events = list()
+    for e in events:
+        trace_events.append(dict(
+            name=e['call'],
+            cat=e['phase'],
+            ph='X',
+            ts=int((e['start'] - _start) * 1e6),
+            dur=int(e['seconds'] * 1e6),
+            pid=os.getpid(),
+            tid=e['tid'],
+            args=dict(repo=e['repo'], returncode=e['returncode'], bytes=e['bytes']),
+        ))
+    return dict(traceEvents=trace_events, displayTimeUnit='ms')
+
+def write_trace(fn, events):
+    with open(fn, 'w') as fp:
+        json.dump(as_chrome_trace(events), fp, indent=1)
+
+def summarize(events):
+    """Return text with subprocess time per repo and per phase.
+    Threads overlap, so the sums can exceed the wall time.
+    """
+    lines = ['Subprocess time: {:.1f}s in {} calls, over {:.1f}s wall time.'.format(
+        sum(e['seconds'] for e in events), len(events), time.time() - _start)]
+    for key in ('repo', 'phase'):
+        seconds = collections.defaultdict(float)
+        counts = collections.defaultdict(int)
+        for e in events:
+            seconds[e[key]] += e['seconds']
+            counts[e[key]] += 1
+        lines.append('By {}:'.format(key))
+        for name, secs in sorted(seconds.iteritems(), key=lambda kv: -kv[1]):
+            lines.append('  {:7.2f}s {:4} calls  {}'.format(secs, counts[name], name or '-'))
+    return '\n'.join(lines)
+
+def finish(trace_fn=None, level=logging.INFO):
+    """Write the trace (if requested) and log the summary.
+    """
+    events = get_events()
+    if trace_fn:
+        write_trace(trace_fn, events)
+        log.log(level, 'Wrote trace of {} subprocesses to {!r}'.format(len(events), trace_fn))
+    if events:
+        log.log(level, summarize(events))
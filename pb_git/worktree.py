@@ -0,0 +1,196 @@
+"""
+Worktree mode: one central bare repo per URL on this host, and a
+'git worktree' of it in each workspace.
+
+Many workspaces of one superproject then share a single object store,
+and a checkout only has to write files. The central repo keeps
+remote-tracking branches for "origin" (and "mirror", if used), which
+every worktree sees, so 'verify' and 'prepare' work as usual.
+
+When a workspace is deleted, its worktree stays registered in the
+central repo until pruned ('pb-git worktrees --prune').
+"""
+from __future__ import absolute_import
+from . import cmds
+from . import refs
+import os
+import shutil
+import sys
+
+log = cmds.log
+
+WORKTREE_DIR_ENV = 'PB_GIT_WORKTREE_DIR'
+
+def get_central(base, url):
+    from . import cache
+    return os.path.join(os.path.abspath(base), cache.url_key(url) + '.git')
+
+def set_remote(central, remote, url):
+    """Add or re-point a remote of the central repo, with remote-tracking
+    branches (which a bare clone would not have).
+    """
+    try:
+        cmds.capture('git --git-dir={} remote set-url {} {}'.format(central, remote, url), log=cmds.log_debug_sys)
+    except IOError:
+        cmds.capture('git --git-dir={} remote add {} {}'.format(central, remote, url), log=cmds.log_debug_sys)
+
+def ensure_central(base, url):
+    """Return the central bare repo for url, creating it if needed.
+    """
+    central = get_central(base, url)
+    if not os.path.isdir(central):
+        cmds.mkdirs(os.path.dirname(central))
+        tmp = '{}.{}.tmp'.format(central, os.getpid())
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        cmds.capture('git init --quiet --bare {}'.format(tmp), log=cmds.log_debug_sys)
+        set_remote(tmp, 'origin', url)
+        os.rename(tmp, central)
+    return central
+
+def fetch(central, remote, sha1, opts):
+    """Fetch from remote until central has sha1.
+    """
+    if cmds.has_commit(central, sha1):
+        return
+    cmds.fetch_sha1(central, remote, sha1, opts)
+    if not cmds.has_commit(central, sha1):
+        raise IOError('Remote "{}" does not have {}.'.format(remote, sha1))
+
+def is_worktree_of(path, central):
+    """Is path a linked worktree of central?
+    """
+    try:
+        gitdir = refs.find_git_dir(os.path.join(cmds.getcwd(), path))
+    except refs.ResolveError:
+        return False
+    return bool(gitdir) and refs.find_common_dir(gitdir) == os.path.normpath(central)
+
+def checkout_repo(conf, mirror_url, opts):
+    """Check out conf['sha1'] at conf['path'], as a worktree of the central repo.
+    Try mirror_url (if any) before the origin.
+    """
+    from . import locks
+    path = conf['path']
+    sha1 = conf['sha1']
+    url = conf['url']
+    central = get_central(opts['worktrees'], url)
+    with locks.get_lock(central):
+        ensure_central(opts['worktrees'], url)
+        fetched = False
+        if mirror_url:
+            try:
+                set_remote(central, 'mirror', mirror_url)
+                fetch(central, 'mirror', sha1, opts)
+                fetched = True
+            except Exception:
+                log.debug('Failure to fetch from mirror.', exc_info=True)
+                log.warning('Failed to fetch "{}" from mirror "{}". Trying the origin.'.format(path, mirror_url))
+        if not fetched:
+            set_remote(central, 'origin', url)
+            fetch(central, 'origin', sha1, opts)
+        abspath = os.path.join(cmds.getcwd(), path)
+        if not is_worktree_of(path, central):
+            if os.path.exists(abspath) and os.listdir(abspath):
+                raise Exception('"{}" exists, but is not a worktree of "{}".'.format(path, central))
+            # A deleted workspace could leave a stale registration for this path.
+            cmds.capture('git --git-dir={} worktree prune'.format(central), log=cmds.log_debug_sys)
+            # A sparse worktree is checked out only after the sparse-checkout is set up.
+            options = ' --no-checkout' if opts.get('sparse') else ''
+            cmds.capture('git --git-dir={} worktree add{} --detach {} {}'.format(central, options, abspath, sha1),
+                    log=cmds.log_info_sys)
+            if not opts.get('sparse'):
+                return
+        # Per worktree (extensions.worktreeConfig), so other workspaces are not affected.
+        enable_worktree_config(central)
+        cmds.apply_sparse(path, opts)
+        cmds.capture('git -C {} checkout --quiet {}'.format(path, sha1), log=cmds.log_info_sys)
+
+def enable_worktree_config(central):
+    """Give each worktree its own config (config.worktree), so that a sparse
+    checkout in one workspace does not change the others. 'sparse-checkout set'
+    does this itself only since git 2.36; before that, it would write
+    core.sparseCheckout into the shared config of the central repo.
+    Like git, move core.bare out of the shared config, into the central repo's own.
+    """
+    def config(args):
+        return cmds.capture('git --git-dir={} config {}'.format(central, args), log=cmds.log_debug_sys)[0].strip()
+    try:
+        if config('--bool extensions.worktreeConfig') == 'true':
+            return
+    except IOError:
+        pass # unset
+    config('core.repositoryformatversion 1')
+    config('extensions.worktreeConfig true')
+    try:
+        bare = config('--bool core.bare')
+    except IOError:
+        return
+    config('--worktree core.bare {}'.format(bare))
+    config('--unset core.bare')
+
+def list_worktrees(central):
+    """Return list of dict(path, sha1, prunable), from 'git worktree list'.
+    The central repo itself is skipped.
+    """
+    out, _ = cmds.capture('git --git-dir={} worktree list --porcelain'.format(central), log=cmds.log_debug_sys)
+    worktrees = list()
+    for block in out.strip().split('\n\n'):
+        wt = dict()
+        for line in block.splitlines():
+            key, _, val = line.partition(' ')
+            wt[key] = val
+        if 'bare' in wt or 'worktree' not in wt:
+            continue
+        worktrees.append(dict(path=wt['worktree'], sha1=wt.get('HEAD'),
+            prunable=not os.path.isdir(wt['worktree'])))
+    return worktrees
+
+def list_centrals(base):
+    """Return list of dict(central, url, worktrees).
+    """
+    centrals = list()
+    if not os.path.isdir(base):
+        return centrals
+    for name in sorted(os.listdir(base)):
+        central = os.path.join(os.path.abspath(base), name)
+        if not name.endswith('.git') or not os.path.isdir(central):
+            continue
+        try:
+            url, _ = cmds.capture('git --git-dir={} config remote.origin.url'.format(central), log=cmds.log_debug_sys)
+        except IOError:
+            url = ''
+        centrals.append(dict(central=central, url=url.strip(), worktrees=list_worktrees(central)))
+    return centrals
+
+def prune(base):
+    """Forget worktrees whose workspaces were deleted.
+    Return the number pruned.
+    """
+    count = 0
+    for c in list_centrals(base):
+        stale = [wt for wt in c['worktrees'] if wt['prunable']]
+        if stale:
+            for wt in stale:
+                log.warning('Pruning worktree "{}" of "{}".'.format(wt['path'], c['url']))
+            cmds.capture('git --git-dir={} worktree prune'.format(c['central']), log=cmds.log_debug_sys)
+            count += len(stale)
+    return count
+
+def format_centrals(centrals):
+    lines = list()
+    for c in centrals:
+        lines.append('{} {}'.format(os.path.basename(c['central']), c['url']))
+        for wt in c['worktrees']:
+            lines.append('    {} {}{}'.format(wt['sha1'], wt['path'], ' (deleted)' if wt['prunable'] else ''))
+    return '\n'.join(lines) + '\n' if lines else ''
+
+def manage(args):
+    """Show the central repos and their worktrees, and prune if asked.
+    """
+    cmds.init(args)
+    if not args.worktrees:
+        raise Exception('No worktrees directory. Use --worktrees or {}.'.format(WORKTREE_DIR_ENV))
+    if args.prune:
+        prune(args.worktrees)
+    sys.stdout.write(format_centrals(list_centrals(args.worktrees)))
@@ -0,0 +1,186 @@
+"""
+Generate synthetic multi-repo trees, for tests and benchmarks.
+
+Layout under base:
+    remotes/NAME.git        bare "origin" repos
+    ws/ext/pi/NAME.ini      the workspace (--directory)
+    mirrors/ext/pi/NAME     optional directory-style mirror, as get_mirror_dir() expects
+    bin/p4                  optional stand-in p4, which records its calls
+"""
+from contextlib import contextmanager
+import json
+import logging
+import os
+import random
+import stat
+import StringIO
+import subprocess
+import sys
+
+GIT_ENV = dict(
+    GIT_AUTHOR_NAME='pb-git-fixture',
+    GIT_AUTHOR_EMAIL='pb-git@example.com',
+    GIT_COMMITTER_NAME='pb-git-fixture',
+    GIT_COMMITTER_EMAIL='pb-git@example.com',
+)
+
+def git(args, cwd=None, stdin=None):
+    """Return stdout. Raise on failure.
+    """
+    env = dict(os.environ, **GIT_ENV)
+    proc = subprocess.Popen(['git'] + args, cwd=cwd, env=env,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate(stdin)
+    if proc.returncode:
+        raise Exception('git {} -> {}\n{}'.format(' '.join(args), proc.returncode, err))
+    return out
+
+def make_content(rng, size):
+    words = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'pacbio', 'falcon', 'pith']
+    chunks = list()
+    total = 0
+    while total < size:
+        word = rng.choice(words)
+        chunks.append(word)
+        total += len(word) + 1
+    return ' '.join(chunks)[:size] + '\n'
+
+def fast_import_stream(nfiles, file_size, ncommits, seed, branch='master', parent=None, start=0):
+    """Each commit rewrites one file; the first writes them all.
+    """
+    rng = random.Random(seed)
+    lines = list()
+    for i in range(start, start + ncommits):
+        msg = 'commit {}\n'.format(i)
+        lines.append('commit refs/heads/{}'.format(branch))
+        lines.append('committer pb-git-fixture <pb-git@example.com> {} +0000'.format(1400000000 + i))
+        lines.append('data {}\n{}'.format(len(msg), msg))
+        if i == start and parent:
+            lines.append('from {}'.format(parent))
+        if i == 0:
+            targets = range(nfiles)
+        else:
+            targets = [i % nfiles]
+        for f in targets:
+            content = make_content(rng, file_size)
+            lines.append('M 100644 inline dir{}/file{}.txt'.format(f % 4, f))
+            lines.append('data {}\n{}'.format(len(content), content))
+        lines.append('')
+    return '\n'.join(lines) + '\n'
+
+def make_remote(path, nfiles=10, file_size=1000, ncommits=10, seed=0):
+    """Create a bare repo with ncommits of history.
+    Return sha1 of master.
+    """
+    git(['init', '-q', '--bare', path])
+    git(['symbolic-ref', 'HEAD', 'refs/heads/master'], cwd=path)
+    git(['fast-import', '--quiet'], cwd=path, stdin=fast_import_stream(nfiles, file_size, ncommits, seed))
+    return git(['rev-parse', 'master'], cwd=path).strip()
+
+def add_commits(path, ncommits=1, nfiles=10, file_size=1000, seed=1):
+    """Advance master of a bare repo.
+    Return the new sha1.
+    """
+    parent = git(['rev-parse', 'master'], cwd=path).strip()
+    start = int(git(['rev-list', '--count', 'master'], cwd=path))
+    stream = fast_import_stream(nfiles, file_size, ncommits, seed, parent=parent, start=start)
+    git(['fast-import', '--quiet'], cwd=path, stdin=stream)
+    return git(['rev-parse', 'master'], cwd=path).strip()
+
+def write_ini(fn, cfg):
+    with open(fn, 'w') as fp:
+        fp.write('[general]\n')
+        for key, val in sorted(cfg.items()):
+            fp.write('{} = {}\n'.format(key, val))
+        fp.write('\n')
+
+def make_tree(base, nrepos=3, nfiles=10, file_size=1000, ncommits=10, mirror=False):
+    """Return dict(workspace, mirrors, remotes, repos={name: cfg}).
+    """
+    base = os.path.abspath(base)
+    tree = dict(
+        workspace=os.path.join(base, 'ws', 'ext', 'pi'),
+        mirrors=os.path.join(base, 'mirrors') if mirror else '',
+        remotes=os.path.join(base, 'remotes'),
+        repos=dict(),
+    )
+    os.makedirs(tree['workspace'])
+    for i in range(nrepos):
+        name = 'repo{:03d}'.format(i)
+        remote = os.path.join(tree['remotes'], name + '.git')
+        sha1 = make_remote(remote, nfiles, file_size, ncommits, seed=i)
+        cfg = dict(path=name, sha1=sha1, url=remote)
+        write_ini(os.path.join(tree['workspace'], name + '.ini'), cfg)
+        tree['repos'][name] = cfg
+        if mirror:
+            sync_mirror(tree, name)
+    return tree
+
+def sync_mirror(tree, name):
+    """(Re-)create the directory-style mirror of one repo.
+    """
+    mirror = os.path.join(tree['mirrors'], 'ext', 'pi', tree['repos'][name]['path'])
+    if os.path.exists(mirror):
+        git(['fetch', '-q', '--prune', 'origin'], cwd=mirror)
+    else:
+        git(['clone', '-q', '--mirror', tree['repos'][name]['url'], mirror])
+
+def bump(tree, name, ncommits=1):
+    """Add commits to one remote, and point its ini at the new tip.
+    Return the new sha1.
+    """
+    cfg = tree['repos'][name]
+    cfg['sha1'] = add_commits(cfg['url'], ncommits, seed=ncommits)
+    write_ini(os.path.join(tree['workspace'], name + '.ini'), cfg)
+    return cfg['sha1']
+
+P4_STUB = """#!/usr/bin/env python
+# Stand-in for p4. Record each call as one JSON line: argv, plus the
+# contents of any '-x' argument file.
+import json, sys
+call = dict(argv=sys.argv[1:])
+if '-x' in sys.argv:
+    call['x'] = open(sys.argv[sys.argv.index('-x') + 1]).read().split()
+with open({log!r}, 'a') as fp:
+    fp.write(json.dumps(call) + '\\n')
+"""
+
+def make_p4_stub(bindir):
+    """Write bindir/p4, which records its calls in bindir/p4.log.
+    Return the log filename.
+    """
+    if not os.path.isdir(bindir):
+        os.makedirs(bindir)
+    log = os.path.join(bindir, 'p4.log')
+    fn = os.path.join(bindir, 'p4')
+    with open(fn, 'w') as fp:
+        fp.write(P4_STUB.format(log=log))
+    os.chmod(fn, os.stat(fn).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    open(log, 'w').close()
+    return log
+
+def read_p4_calls(log):
+    with open(log) as fp:
+        return [json.loads(line) for line in fp if line.strip()]
+
+@contextmanager
+def isolated(**env):
+    """Run a command function as the command-line would, but restore
+    what it changes: the root logging handlers (which cmds.init() replaces),
+    os.environ (updated with env), and sys.stdout, which is captured.
+    Yield the StringIO with the captured output.
+    """
+    handlers = logging.getLogger().handlers[:]
+    saved_env = dict(os.environ)
+    stdout = sys.stdout
+    os.environ.update(env)
+    sys.stdout = StringIO.StringIO()
+    try:
+        yield sys.stdout
+    finally:
+        sys.stdout = stdout
+        for key in list(os.environ):
+            if key not in saved_env:
+                del os.environ[key]
+        os.environ.update(saved_env)
+        logging.getLogger().handlers[:] = handlers
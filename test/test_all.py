@@ -1,10 +1,18 @@
 from pb_git import (cmds, convert)
+import argparse
+import fixtures
+import logging
 import nose.tools as nt
+import os
 import StringIO
 import sys
+import tempfile
 
 ver = sys.version[:3]
 
+# Do not touch ~/.cache/pb-git.
+os.environ['PB_GIT_STATE_DIR'] = tempfile.mkdtemp()
+
 def test_capture():
     nt.assert_equal('hi', cmds.capture('echo hi')[0].strip())
 
@@ -37,3 +45,658 @@ def test_map_sha1s():
     s = convert.map_sha1s(git_submodules_content)
     expected = {'FALCON': '3e2231218d94f1f2a9083ae5695fb0d888b3e405', 'DALIGNER': '5d527739295c82bf4a141532d61019b9d155cc99', 'pith': '64d08e363e88b9356b587f2524fdc299a61d0791'}
     nt.assert_equal(expected, s)
+
+def test_parallel_map():
+    nt.assert_equal([1, 4, 9], cmds.parallel_map(lambda x: x*x, [1, 2, 3], jobs=3))
+
+def test_parallel_map_failure():
+    def func(x):
+        if x == 2:
+            raise ValueError(x)
+        return x
+    nt.assert_raises(ValueError, cmds.parallel_map, func, [1, 2, 3], 2)
+
+def test_system_failure_output_in_parallel():
+    class Handler(logging.Handler):
+        def __init__(self):
+            logging.Handler.__init__(self)
+            self.records = list()
+        def emit(self, record):
+            self.records.append(record)
+    hdlr = Handler()
+    cmds.log.addHandler(hdlr)
+    try:
+        with cmds.log_grouped():
+            nt.assert_raises(IOError, cmds.system, 'echo oops; false')
+    finally:
+        cmds.log.removeHandler(hdlr)
+    nt.assert_equal(['oops'], [r.getMessage() for r in hdlr.records if r.levelno >= logging.ERROR])
+
+def test_mkdirs_in_threads():
+    base = tempfile.mkdtemp()
+    dirs = [os.path.join(base, 'ext', 'pi', str(i % 4)) for i in range(16)]
+    cmds.parallel_map(cmds.mkdirs, dirs, 16)
+    nt.assert_equal(['0', '1', '2', '3'], sorted(os.listdir(os.path.join(base, 'ext', 'pi'))))
+
+def test_cd_in_threads():
+    dirs = [tempfile.mkdtemp() for _ in range(4)]
+    def func(d):
+        with cmds.cd(d):
+            return cmds.capture('pwd')[0].strip()
+    cwd = os.getcwd()
+    got = cmds.parallel_map(func, dirs, jobs=4)
+    nt.assert_equal([os.path.realpath(d) for d in dirs], [os.path.realpath(d) for d in got])
+    nt.assert_equal(cwd, os.getcwd())
+
+def test_check_verified():
+    results = [
+        cmds.VerifyResult('foo', 'abc', 'fast', 0.1, None),
+        cmds.VerifyResult('bar', 'def', None, 0.2, 'oops'),
+        cmds.VerifyResult('baz', 'ghi', None, 0.3, 'nope'),
+    ]
+    with nt.assert_raises(Exception) as cm:
+        cmds.check_verified(results)
+    msg = str(cm.exception)
+    nt.assert_in('bar def: oops', msg)
+    nt.assert_in('baz ghi: nope', msg)
+
+git_env = 'GIT_AUTHOR_NAME=a GIT_AUTHOR_EMAIL=a@b GIT_COMMITTER_NAME=a GIT_COMMITTER_EMAIL=a@b'
+
+# For 'git submodule add' of a local path.
+FILE_PROTOCOL_ENV = dict(GIT_CONFIG_COUNT='1', GIT_CONFIG_KEY_0='protocol.file.allow', GIT_CONFIG_VALUE_0='always')
+
+def make_repo(path):
+    """Return sha1 of HEAD, in a new repo with 2 commits.
+    """
+    cmds.system('git init -q {0} && cd {0} && echo 1 > f && git add f && {1} git commit -qm one && echo 2 >> f && {1} git commit -qam two'.format(
+        path, git_env))
+    return cmds.capture('git -C {} rev-parse HEAD'.format(path))[0].strip()
+
+def test_cache():
+    from pb_git import cache
+    tmp = tempfile.mkdtemp()
+    remote = os.path.join(tmp, 'remote')
+    sha1 = make_repo(remote)
+    url = 'file://' + remote
+    cache_dir = os.path.join(tmp, 'cache')
+    path = os.path.join(tmp, 'ws', 'foo')
+    cmds.capture('git -C {} update-ref refs/pull/1/head HEAD~1'.format(remote))
+    cmds.checkout_repo_from_url(url, sha1, 'origin', path, opts=dict(cache_dir=cache_dir))
+    entries = cache.list_entries(cache_dir)
+    nt.assert_equal(1, len(entries))
+    nt.assert_equal([os.path.join(path, '.git')], entries[0]['borrowers'])
+    # Only branches and tags, not e.g. GitHub's refs/pull/*.
+    nt.assert_equal('', cmds.capture('git --git-dir={} for-each-ref refs/pull'.format(entries[0]['entry']))[0])
+    # A clone from a mirror shares the entry of the origin.
+    mirror = os.path.join(tmp, 'mirror.git')
+    cmds.capture('git clone -q --mirror {} {}'.format(remote, mirror))
+    mirrored = os.path.join(tmp, 'ws', 'mirrored')
+    cmds.checkout_repo_from_url('file://' + mirror, sha1, 'mirror', mirrored, opts=dict(cache_dir=cache_dir), origin_url=url)
+    entries = cache.list_entries(cache_dir)
+    nt.assert_equal(1, len(entries))
+    nt.assert_equal(sorted(os.path.join(p, '.git') for p in (path, mirrored)), sorted(entries[0]['borrowers']))
+    cmds.system('rm -rf {}'.format(mirrored))
+    # Eviction must not break the borrower.
+    nt.assert_equal(1, len(cache.prune(cache_dir, 0)))
+    nt.assert_equal([], cache.list_entries(cache_dir))
+    nt.assert_false(os.path.exists(cache.get_alternates_fn(os.path.join(path, '.git'))))
+    cmds.capture('git -C {} fsck --no-dangling'.format(path))
+    # A clone which has not finished yet keeps its entry.
+    other = os.path.join(tmp, 'ws', 'bar', '.git')
+    cache.ensure(cache_dir, url, sha1, other)
+    nt.assert_equal([], cache.prune(cache_dir, 0))
+    cache.add_borrower(cache.get_entry(cache_dir, url), other)
+    nt.assert_equal(1, len(cache.prune(cache_dir, 0)))
+
+def test_read_head():
+    from pb_git import refs
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, 'foo')
+    sha1 = make_repo(path)
+    def rev_parse(p):
+        return cmds.capture('git -C {} rev-parse HEAD'.format(p))[0].strip()
+    nt.assert_equal(sha1, refs.read_head(path)) # loose branch
+    cmds.capture('git -C {} pack-refs --all'.format(path))
+    nt.assert_equal(sha1, refs.read_head(path)) # packed branch
+    cmds.capture('git -C {} checkout -q HEAD~1'.format(path))
+    nt.assert_equal(rev_parse(path), refs.read_head(path)) # detached
+    wt = os.path.join(tmp, 'wt')
+    cmds.capture('git -C {} worktree add -q --detach {} {}'.format(path, wt, sha1))
+    nt.assert_equal(sha1, refs.read_head(wt)) # gitfile, commondir
+    nt.assert_equal(sha1, cmds.get_sha1(wt))
+    nt.assert_raises(refs.ResolveError, refs.read_head, tmp)
+
+def test_journal():
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, 'foo')
+    sha1 = make_repo(path)
+    cfg = dict(path=path, sha1=sha1, url='unused')
+    entry = cmds.get_journal_entry(cfg)
+    fn = os.path.join(tmp, 'journal.json')
+    cmds.write_journal(fn, dict(foo=entry))
+    entry = cmds.read_journal(fn)['foo']
+    nt.assert_true(cmds.is_unchanged(cfg, entry))
+    nt.assert_false(cmds.is_unchanged(dict(cfg, sha1='0'*40), entry))
+    # A commit on the branch moves only the branch ref, not HEAD.
+    head_mtime = os.stat(os.path.join(path, '.git', 'HEAD')).st_mtime
+    cmds.system('cd {} && {} git commit -q --allow-empty -m three'.format(path, git_env))
+    nt.assert_equal(head_mtime, os.stat(os.path.join(path, '.git', 'HEAD')).st_mtime)
+    nt.assert_false(cmds.is_unchanged(cfg, entry))
+    cmds.system('git -C {} reset -q --hard {}'.format(path, sha1))
+    nt.assert_true(cmds.is_unchanged(cfg, entry))
+    os.utime(os.path.join(path, '.git', 'HEAD'), (1, 1))
+    nt.assert_false(cmds.is_unchanged(cfg, entry))
+
+def test_shallow_sha1_fetch():
+    tmp = tempfile.mkdtemp()
+    remote = os.path.join(tmp, 'remote')
+    make_repo(remote)
+    old = cmds.capture('git -C {} rev-parse HEAD~1'.format(remote))[0].strip()
+    path = os.path.join(tmp, 'ws', 'foo')
+    opts = dict(depth='1', fetch='sha1')
+    cmds.checkout_repo_from_url('file://' + remote, old, 'origin', path, opts=opts)
+    nt.assert_equal(old, cmds.get_sha1(path))
+    nt.assert_true(cmds.is_shallow(path))
+
+def test_mirror_probe_cached():
+    from pb_git import mirrors, remotes
+    calls = list()
+    orig_probe = mirrors.probe
+    mirrors.probe = lambda base: calls.append(base) or False
+    remotes._stats = None
+    try:
+        with fixtures.isolated(PB_GIT_STATE_DIR=tempfile.mkdtemp(), PB_GIT_DEFAULT_MIRRORS_BASE='git://nowhere'):
+            nt.assert_false(mirrors.is_reachable('git://nowhere', ttl=60))
+            nt.assert_false(mirrors.is_reachable('git://nowhere', ttl=60))
+            nt.assert_equal(['git://nowhere'], calls)
+            # A failed probe counts against the remote, untimed, but does not disable the mirror.
+            stat = remotes.read_stats()['nowhere']
+            nt.assert_equal((1, 1, None), (stat['attempts'], stat['failures'], stat['seconds']))
+            nt.assert_equal('git://nowhere', mirrors.resolve(None))
+            mirrors.is_reachable('git://nowhere', ttl=0)
+            nt.assert_equal(2, len(calls))
+    finally:
+        mirrors.probe = orig_probe
+        remotes._stats = None
+
+def test_trace():
+    from pb_git import trace
+    with trace.context(repo='foo', phase='verify'):
+        cmds.capture('echo hello')
+    e = trace.get_events()[-1]
+    nt.assert_equal(('foo', 'verify', 0, 6), (e['repo'], e['phase'], e['returncode'], e['bytes']))
+    chrome = trace.as_chrome_trace([e])
+    nt.assert_equal('X', chrome['traceEvents'][0]['ph'])
+    nt.assert_in('foo', trace.summarize([e]))
+
+def test_fixture_tree_with_mirror():
+    tree = fixtures.make_tree(tempfile.mkdtemp(), nrepos=2, nfiles=3, ncommits=3, mirror=True)
+    with cmds.cd(tree['workspace']):
+        for name, cfg in sorted(tree['repos'].items()):
+            cmds.checkout_repo(cfg, tree['mirrors'])
+            nt.assert_equal(cfg['sha1'], cmds.get_sha1(cfg['path']))
+            remotes = cmds.capture('git -C {} remote'.format(cfg['path']))[0].split()
+            nt.assert_equal(['mirror', 'origin'], sorted(remotes))
+
+def test_verify_repo_cached():
+    tmp = tempfile.mkdtemp()
+    remote = os.path.join(tmp, 'remote')
+    sha1 = make_repo(remote)
+    path = os.path.join(tmp, 'foo')
+    cmds.checkout_repo_from_url(remote, sha1, 'origin', path)
+    cmds.system('cd {} && {} git commit -q --allow-empty -m local'.format(path, git_env))
+    local = cmds.get_sha1(path)
+    nt.assert_equal(None, cmds.find_containing_ref(path, local))
+    nt.assert_true(cmds.find_containing_ref(path, sha1).startswith('refs/remotes/origin/'))
+    # Not on the likeliest branch, nor a tip.
+    cmds.system('cd {} && git checkout -q -b feature && {} git commit -q --allow-empty -m a && {} git commit -q --allow-empty -m b'.format(
+        remote, git_env, git_env))
+    cmds.capture('git -C {} fetch -q origin'.format(path))
+    feature = cmds.capture('git -C {} rev-parse feature~1'.format(remote))[0].strip()
+    nt.assert_equal('refs/remotes/origin/feature', cmds.find_containing_ref(path, feature))
+    cmds._verified = None
+    cfg = dict(path=path, url=remote, sha1=sha1)
+    nt.assert_equal('fast', cmds.verify_repo('foo', cfg, sha1))
+    cmds._verified = None # Re-read from disk.
+    nt.assert_equal('cached', cmds.verify_repo('foo', cfg, sha1))
+
+def test_verify_repo_slow():
+    tmp = tempfile.mkdtemp()
+    remote = os.path.join(tmp, 'remote')
+    make_repo(remote)
+    old = cmds.capture('git -C {} rev-parse HEAD~1'.format(remote))[0].strip()
+    cfg = dict(path='unused', url='file://' + remote)
+    cmds.verify_repo_slow('foo', cfg, old)
+    gitdir = cmds.get_scratch_repo(cfg['url'])
+    nt.assert_true(cmds.has_commit(gitdir, old))
+    nt.assert_false(os.path.exists(os.path.join(gitdir, 'index'))) # no checkout
+    nt.assert_raises(Exception, cmds.verify_repo_slow, 'foo', cfg, '0123456789' * 4)
+    # The scratch repo is a partial clone, but has_commit() must not fetch.
+    cmds.system('cd {} && {} git commit -q --allow-empty -m new && git config uploadpack.allowFilter true && git config uploadpack.allowAnySHA1InWant true'.format(
+        remote, git_env))
+    head = cmds.capture('git -C {} rev-parse HEAD'.format(remote))[0].strip()
+    nt.assert_false(cmds.has_commit(gitdir, head))
+    nt.assert_false(cmds.has_commit(gitdir, head)) # Still not fetched.
+
+def test_prepare_batches_p4():
+    base = tempfile.mkdtemp()
+    tree = fixtures.make_tree(base, nrepos=3, nfiles=2, ncommits=2)
+    p4log = fixtures.make_p4_stub(os.path.join(base, 'bin'))
+    ws = tree['workspace']
+    with cmds.cd(ws):
+        for name, cfg in sorted(tree['repos'].items()):
+            cmds.checkout_repo(cfg, '')
+    for name in ('repo000', 'repo002'):
+        cfg = tree['repos'][name]
+        sha1 = fixtures.add_commits(cfg['url'], seed=7)
+        fixtures.git(['fetch', '-q', 'origin'], cwd=os.path.join(ws, name))
+        fixtures.git(['checkout', '-q', sha1], cwd=os.path.join(ws, name))
+    args = argparse.Namespace(directory=ws, inis=None, verbosity=0, no_verify=True, jobs=1, trace=None)
+    with fixtures.isolated(PATH=os.path.join(base, 'bin') + os.pathsep + os.environ['PATH']):
+        cmds.prepare(args)
+    edits = [c for c in fixtures.read_p4_calls(p4log) if 'edit' in c['argv']]
+    nt.assert_equal([['repo000.ini', 'repo002.ini']], [c['x'] for c in edits])
+    nt.assert_equal([], [fn for fn in os.listdir(ws) if fn.endswith('.bak')])
+    with open(os.path.join(ws, 'repo000.ini')) as fp:
+        nt.assert_equal(cmds.get_sha1(os.path.join(ws, 'repo000')), cmds.read_repo_config(fp)['sha1'])
+
+def test_index_modules():
+    tmp = tempfile.mkdtemp()
+    fn = os.path.join(tmp, 'foo.ini')
+    index_fn = os.path.join(tmp, 'index.json')
+    fixtures.write_ini(fn, dict(path='foo', sha1='abc', url='u'))
+    os.utime(fn, (1000, 1000))
+    cmds._ini_index.clear()
+    nt.assert_equal('abc', cmds.index_modules([fn], index_fn)[fn]['sha1'])
+    nt.assert_true(os.path.exists(index_fn))
+    # Served from the index, not re-parsed.
+    cmds._ini_index.clear()
+    orig = cmds.read_module
+    cmds.read_module = None
+    try:
+        cfgs = cmds.index_modules([fn], index_fn)
+    finally:
+        cmds.read_module = orig
+    nt.assert_equal([str] * 3, [type(v) for v in cfgs[fn].values()])
+    cfgs[fn]['sha1'] = 'mutated'
+    nt.assert_equal('abc', cmds.index_modules([fn], index_fn)[fn]['sha1'])
+    # Changed file => re-parsed.
+    fixtures.write_ini(fn, dict(path='foo', sha1='def', url='u'))
+    os.utime(fn, (2000, 2000))
+    nt.assert_equal('def', cmds.index_modules([fn], index_fn)[fn]['sha1'])
+    cmds._ini_index.clear()
+
+def test_update_submodules_recovers_one():
+    base = tempfile.mkdtemp()
+    with fixtures.isolated(**FILE_PROTOCOL_ENV):
+        good = os.path.join(base, 'good.git')
+        bad = os.path.join(base, 'bad.git')
+        fixtures.make_remote(good, nfiles=2, ncommits=2, seed=1)
+        fixtures.make_remote(bad, nfiles=2, ncommits=2, seed=2)
+        parent = os.path.join(base, 'parent')
+        make_repo(parent)
+        for sub in (good, bad):
+            fixtures.git(['submodule', '-q', 'add', sub], cwd=parent)
+        fixtures.git(['commit', '-qm', 'subs'], cwd=parent)
+        path = os.path.join(base, 'ws', 'parent')
+        fixtures.git(['clone', '-q', parent, path])
+        nt.assert_equal(['bad', 'good'], [name for name, subpath, url in cmds.list_submodules(path)])
+        cmds.update_submodules(path, jobs=2)
+        marker = os.path.join(path, '.git', 'modules', 'good', 'marker')
+        open(marker, 'w').close()
+        # Break one submodule repo.
+        with open(os.path.join(path, '.git', 'modules', 'bad', 'HEAD'), 'w') as fp:
+            fp.write('garbage\n')
+        cmds.update_submodules(path, jobs=2)
+        nt.assert_true(os.path.exists(marker)) # healthy object store was kept
+        fixtures.git(['fsck', '--no-dangling'], cwd=os.path.join(path, 'bad'))
+        # A submodule which cannot be recovered does not stop the others.
+        os.rename(bad, bad + '.gone')
+        for name in ('bad', 'good'):
+            with open(os.path.join(path, '.git', 'modules', name, 'HEAD'), 'w') as fp:
+                fp.write('garbage\n')
+        with nt.assert_raises(IOError) as cm:
+            cmds.update_submodules(path, jobs=2)
+        nt.assert_true(str(cm.exception).endswith(': bad'))
+        fixtures.git(['fsck', '--no-dangling'], cwd=os.path.join(path, 'good'))
+
+def test_worktree_mode():
+    from pb_git import worktree
+    base = tempfile.mkdtemp()
+    tree = fixtures.make_tree(base, nrepos=1, nfiles=3, ncommits=3)
+    cfg = tree['repos']['repo000']
+    opts = dict(worktrees=os.path.join(base, 'central'))
+    workspaces = [os.path.join(base, 'ws{}'.format(i)) for i in range(2)]
+    for ws in workspaces:
+        os.makedirs(ws)
+        with cmds.cd(ws):
+            cmds.checkout_repo(cfg, '', opts)
+            nt.assert_equal(cfg['sha1'], cmds.get_sha1(cfg['path']))
+            nt.assert_true(os.path.isfile(os.path.join(cfg['path'], '.git')))
+            cmds.verify_repo_fast('repo000', cfg, cfg['sha1'])
+    centrals = worktree.list_centrals(opts['worktrees'])
+    nt.assert_equal(1, len(centrals))
+    nt.assert_equal(2, len(centrals[0]['worktrees']))
+    # Move one workspace ahead; only files change.
+    sha1 = fixtures.add_commits(cfg['url'], seed=5)
+    with cmds.cd(workspaces[0]):
+        cmds.checkout_repo(dict(cfg, sha1=sha1), '', opts)
+        nt.assert_equal(sha1, cmds.get_sha1(cfg['path']))
+    cmds.system('rm -rf {}'.format(workspaces[1]))
+    nt.assert_equal(1, worktree.prune(opts['worktrees']))
+    nt.assert_equal([os.path.join(workspaces[0], 'repo000')],
+            [wt['path'] for wt in worktree.list_worktrees(centrals[0]['central'])])
+
+def test_mirror_sync():
+    from pb_git import mirrors
+    base = tempfile.mkdtemp()
+    tree = fixtures.make_tree(base, nrepos=2, nfiles=3, ncommits=3)
+    mirrors_base = os.path.join(base, 'mymirrors')
+    # Relative to --directory, as for checkout.
+    args = argparse.Namespace(directory=tree['workspace'], inis=None, verbosity=0, trace=None,
+            mirrors=os.path.relpath(mirrors_base, tree['workspace']), jobs=2, needed=True)
+    def sync():
+        with fixtures.isolated():
+            mirrors.sync(args)
+    sync()
+    mirror = os.path.join(mirrors_base, 'ext', 'pi', 'repo000')
+    cfg = tree['repos']['repo000']
+    old = cfg['sha1']
+    nt.assert_true(cmds.has_commit(mirror, old))
+    nt.assert_equal(None, mirrors.read_sync_meta(mirror).get('synced'))
+    def pins():
+        return cmds.capture("git --git-dir={} for-each-ref --format='%(refname)' refs/heads/pb-git".format(mirror))[0].split()
+    # After a new commit, --needed fetches just that.
+    sha1 = fixtures.bump(tree, 'repo000')
+    sync()
+    nt.assert_true(cmds.has_commit(mirror, sha1))
+    nt.assert_equal(['refs/heads/pb-git/' + sha1], pins())
+    # Another workspace's pin survives this one's syncs, even a full one (--prune).
+    other = os.path.join(base, 'other')
+    os.mkdir(other)
+    mirrors.sync_repo(mirror, cfg['url'], old, needed_only=True, workspace=other)
+    sync()
+    args.needed = False
+    sync()
+    nt.assert_equal(sorted('refs/heads/pb-git/' + s for s in (old, sha1)), pins())
+    meta = mirrors.read_sync_meta(mirror)
+    nt.assert_equal(sha1, meta['head'])
+    nt.assert_true(meta['synced'])
+    # The mirror works for checkout.
+    with cmds.cd(tree['workspace']):
+        cmds.checkout_repo(cfg, mirrors_base)
+        nt.assert_equal(sha1, cmds.get_sha1(cfg['path']))
+
+def test_export():
+    from pb_git import export
+    base = tempfile.mkdtemp()
+    tree = fixtures.make_tree(base, nrepos=2, nfiles=3, ncommits=3)
+    out = os.path.join(base, 'out')
+    os.makedirs(out)
+    for name in tree['repos']:
+        fixtures.write_ini(os.path.join(out, name + '.ini'), tree['repos'][name])
+    args = argparse.Namespace(directory=out, inis=None, verbosity=0, trace=None, jobs=2,
+            export_dir=os.path.join(base, 'exports'), unpack=True,
+            manifest='git-manifest.json', csv='git-manifest.csv')
+    with fixtures.isolated():
+        export.export(args)
+        mtime = os.path.getmtime(os.path.join(out, 'repo001', export.STAMP))
+        export.export(args) # all cached
+    nt.assert_equal(mtime, os.path.getmtime(os.path.join(out, 'repo001', export.STAMP)))
+    for name, cfg in tree['repos'].items():
+        nt.assert_true(os.path.exists(export.get_archive(args.export_dir, cfg['url'], cfg['sha1'])))
+        nt.assert_false(os.path.exists(os.path.join(out, name, '.git')))
+        nt.assert_true(os.path.exists(os.path.join(out, name, 'dir0', 'file0.txt')))
+    with open(os.path.join(out, 'git-manifest.csv')) as fp:
+        nt.assert_equal(2, len(fp.read().splitlines()))
+    # Something else at the path is never removed.
+    mine = os.path.join(base, 'mine')
+    os.makedirs(mine)
+    open(os.path.join(mine, 'notes.txt'), 'w').close()
+    cfg = tree['repos']['repo000']
+    archive = export.get_archive(args.export_dir, cfg['url'], cfg['sha1'])
+    nt.assert_raises(Exception, export.unpack, archive, mine, cfg['sha1'])
+    nt.assert_true(os.path.exists(os.path.join(mine, 'notes.txt')))
+
+def test_remote_stats_and_race():
+    from pb_git import remotes
+    base = tempfile.mkdtemp()
+    tree = fixtures.make_tree(base, nrepos=2, nfiles=3, ncommits=3, mirror=True)
+    remotes._stats = None
+    with cmds.cd(tree['workspace']):
+        # No mirror for repo000 yet, so the mirror fails, and origin works.
+        # A mirror which is behind is not unhealthy.
+        cfg = tree['repos']['repo000']
+        cmds.system('rm -rf {}'.format(os.path.join(tree['mirrors'], 'ext', 'pi', 'repo000')))
+        cmds.checkout_repo(cfg, tree['mirrors'])
+        nt.assert_equal(cfg['sha1'], cmds.get_sha1(cfg['path']))
+        stats = remotes.read_stats()
+        nt.assert_equal(None, stats.get(remotes.get_key(os.path.join(tree['mirrors'], 'ext', 'pi', 'x'))))
+        nt.assert_equal(0, stats[remotes.get_key(cfg['url'])]['failures'])
+        nt.assert_equal(['repo000'], stats[remotes.get_key(cfg['url'])]['repos'].keys())
+        # When every source fails, the error is the origin's.
+        bad = dict(cfg, path='bad', sha1='0123456789' * 4)
+        with nt.assert_raises(IOError) as cm:
+            cmds.checkout_repo(bad, tree['mirrors'])
+        nt.assert_in('0123456789', str(cm.exception))
+        # No mirrors => no mirror is tried.
+        remotes._stats = dict()
+        cmds.checkout_repo(dict(cfg, path='nomirror'), '')
+        nt.assert_equal([remotes.get_key(cfg['url'])], remotes.read_stats().keys())
+        # A race never replaces what someone else put there.
+        os.makedirs('mine')
+        open(os.path.join('mine', 'notes.txt'), 'w').close()
+        nt.assert_raises(Exception, remotes.race_clone, [('origin', cfg['url'])], 'mine')
+        nt.assert_true(os.path.exists(os.path.join('mine', 'notes.txt')))
+        # Both can clone repo001, so either may win.
+        cfg = tree['repos']['repo001']
+        cmds.checkout_repo(cfg, tree['mirrors'], dict(race=True))
+        nt.assert_equal(cfg['sha1'], cmds.get_sha1(cfg['path']))
+        nt.assert_equal(['mine', 'nomirror', 'repo000', 'repo001'], sorted(fn for fn in os.listdir('.') if os.path.isdir(fn) and fn != 'bad'))
+
+def test_schedule_estimates():
+    from pb_git import schedule
+    base = tempfile.mkdtemp()
+    tree = fixtures.make_tree(base, nrepos=2, nfiles=3, ncommits=3)
+    small, big = tree['repos']['repo000'], tree['repos']['repo001']
+    fixtures.add_commits(big['url'], ncommits=5, file_size=100000)
+    schedule._timings = None
+    with cmds.cd(tree['workspace']):
+        for cfg in (small, big):
+            cmds.checkout_repo(cfg, '')
+        # No history, so use the size of each object store.
+        nt.assert_true(schedule.estimate(big, '', dict()) > schedule.estimate(small, '', dict()) > 0)
+        schedule.record(small['url'], 100.0, dict(clone=90.0))
+        schedule.record(small['url'], 50.0, dict(clone=40.0))
+        nt.assert_equal(75.0, schedule.estimate(small, '', dict()))
+    schedule.write_timings()
+    schedule._timings = None
+    from pb_git import cache
+    nt.assert_equal(dict(clone=40.0), schedule.read_timings()[cache.normalize_url(small['url'])]['phases'])
+
+def lock_worker(path, counter, created):
+    """Fetch-once pattern: whoever gets the lock first creates the thing.
+    The others wait, then reuse it.
+    """
+    from pb_git import locks
+    with locks.get_lock(path):
+        if not os.path.exists(path):
+            with open(created, 'a') as fp:
+                fp.write('{}\n'.format(os.getpid()))
+            import time
+            time.sleep(0.2)
+            os.mkdir(path)
+        with open(counter) as fp:
+            n = int(fp.read() or 0)
+        with open(counter, 'w') as fp:
+            fp.write(str(n + 1))
+
+def test_locks_across_processes():
+    import multiprocessing
+    tmp = tempfile.mkdtemp()
+    path, counter, created = [os.path.join(tmp, fn) for fn in ('repo.git', 'counter', 'created')]
+    open(counter, 'w').close()
+    procs = [multiprocessing.Process(target=lock_worker, args=(path, counter, created)) for _ in range(6)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+    nt.assert_equal([0] * 6, [p.exitcode for p in procs])
+    nt.assert_equal('6', open(counter).read())
+    nt.assert_equal(1, len(open(created).read().split()))
+    nt.assert_false(os.path.exists(path + '.lock'))
+
+def test_stale_lock_is_broken():
+    from pb_git import locks
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, 'repo.git')
+    # A dead holder on another host, whose heartbeat stopped long ago.
+    os.mkdir(path + '.lock')
+    owner = os.path.join(path + '.lock', locks.OWNER)
+    with open(owner, 'w') as fp:
+        fp.write('{"host": "elsewhere", "pid": 1}')
+    os.utime(owner, (0, 0))
+    with locks.FileLock(path, stale_after=60, timeout=5):
+        nt.assert_true(os.path.exists(path + '.lock'))
+    # A live holder is waited for.
+    with locks.FileLock(path):
+        nt.assert_raises(locks.LockTimeout, locks.FileLock(path, timeout=0.3).acquire)
+        # A lock re-acquired after it was judged stale is not taken over.
+        with open(owner) as fp:
+            live = fp.read()
+        nt.assert_false(locks.FileLock(path).take_over('{"host": "elsewhere", "pid": 1}'))
+        with open(owner) as fp:
+            nt.assert_equal(live, fp.read())
+    nt.assert_false(os.path.exists(path + '.lock'))
+
+def test_checkout_defaults():
+    # 'migrate' runs checkout with these, so every checkout option must be here.
+    defaults = cmds.get_checkout_defaults()
+    nt.assert_equal(('all', 1, None, False), (defaults['fetch'], defaults['jobs'], defaults['mirrors'], defaults['maintain']))
+    nt.assert_true({'cache', 'cache_size', 'worktrees'} <= set(defaults))
+
+def test_migrate_seeds():
+    base = tempfile.mkdtemp()
+    with fixtures.isolated(**FILE_PROTOCOL_ENV):
+        sub = os.path.join(base, 'sub.git')
+        sha1 = fixtures.make_remote(sub, nfiles=2, ncommits=2)
+        parent = os.path.join(base, 'parent')
+        make_repo(parent)
+        fixtures.git(['submodule', '-q', 'add', sub], cwd=parent)
+        fixtures.git(['commit', '-qm', 'subs'], cwd=parent)
+    seeds = convert.find_seeds(parent)
+    nt.assert_equal(['sub'], seeds.keys())
+    ws = os.path.join(base, 'ws')
+    os.makedirs(ws)
+    # The origin is gone, so this works only without the network.
+    cfg = dict(path='sub', sha1=sha1, url=os.path.join(base, 'gone.git'))
+    with cmds.cd(ws):
+        cmds.checkout_repo_from_url(cfg['url'], sha1, 'origin', 'sub', opts=dict(seeds=seeds))
+        nt.assert_equal(sha1, cmds.get_sha1('sub'))
+        nt.assert_equal('refs/remotes/origin/master', cmds.find_containing_ref('sub', sha1))
+
+def test_status():
+    from pb_git import status
+    base = tempfile.mkdtemp()
+    tree = fixtures.make_tree(base, nrepos=3, nfiles=2, ncommits=2)
+    ws = tree['workspace']
+    with cmds.cd(ws):
+        for name in ('repo000', 'repo001'):
+            cmds.checkout_repo(tree['repos'][name], '')
+    open(os.path.join(ws, 'repo000', 'new.txt'), 'w').close()
+    fixtures.git(['commit', '-q', '--allow-empty', '-m', 'local'], cwd=os.path.join(ws, 'repo001'))
+    args = argparse.Namespace(directory=ws, inis=None, verbosity=0, trace=None, jobs=3, json=True)
+    with fixtures.isolated() as stdout:
+        status.status(args)
+    out = stdout.getvalue()
+    import json
+    got = dict((st['name'], st) for st in json.loads(out))
+    nt.assert_equal(('dirty', 1), (got['repo000']['state'], got['repo000']['untracked']))
+    nt.assert_equal(('off-ini', 1, 0), (got['repo001']['state'], got['repo001']['ahead'], got['repo001']['behind']))
+    nt.assert_equal('missing', got['repo002']['state'])
+    nt.assert_equal(4, len(status.format_table(got.values()).splitlines()))
+
+def test_plan():
+    from pb_git import plan
+    base = tempfile.mkdtemp()
+    tree = fixtures.make_tree(base, nrepos=4, nfiles=2, ncommits=2)
+    ws = tree['workspace']
+    repos = tree['repos']
+    with cmds.cd(ws):
+        for name in ('repo000', 'repo001', 'repo002'):
+            cmds.checkout_repo(repos[name], '')
+        old = cmds.capture('git -C repo001 rev-parse HEAD~1')[0].strip()
+        cmds.capture('git -C repo001 checkout -q {}'.format(old))
+        fixtures.bump(tree, 'repo002')
+        plans = plan.plan_repos(sorted(repos.items()), dict(), jobs=2)
+        nt.assert_equal(dict(repo000='up-to-date', repo001='checkout-only', repo002='fetch-needed',
+            repo003='clone-needed'), plans)
+        # checkout fetches first, instead of failing a checkout.
+        cmds.checkout_repo_from_url(repos['repo002']['url'], repos['repo002']['sha1'], 'origin', 'repo002',
+                opts=dict(plans={'repo002': 'fetch-needed'}))
+        nt.assert_equal(repos['repo002']['sha1'], cmds.get_sha1('repo002'))
+
+def test_sparse_checkout():
+    cfg = dict(path='foo', sha1='0' * 40, url='x', sparse='src/a\ndocs')
+    ofs = StringIO.StringIO()
+    cmds.write_repo_config(ofs, cfg)
+    nt.assert_equal(cfg, cmds.read_repo_config(StringIO.StringIO(ofs.getvalue())))
+    tmp = tempfile.mkdtemp()
+    remote = os.path.join(tmp, 'remote')
+    cmds.system('git init -q {0} && cd {0} && mkdir -p src/a src/b docs && touch top src/a/f src/b/f docs/f && git add . && {1} git commit -qm one'.format(
+        remote, git_env))
+    sha1 = cmds.capture('git -C {} rev-parse HEAD'.format(remote))[0].strip()
+    with cmds.cd(tmp):
+        conf = dict(path='foo', sha1=sha1, url='file://' + remote, sparse='src/a, docs')
+        cmds.checkout_repo(conf, '')
+        nt.assert_equal(['docs', 'src/a'], cmds.get_sparse_state('foo'))
+        nt.assert_true(os.path.exists('foo/src/a/f'))
+        nt.assert_true(os.path.exists('foo/top')) # cone mode keeps top-level files
+        nt.assert_false(os.path.exists('foo/src/b'))
+        # Without the key, the whole tree comes back.
+        del conf['sparse']
+        cmds.checkout_repo(conf, '')
+        nt.assert_equal(None, cmds.get_sparse_state('foo'))
+        nt.assert_true(os.path.exists('foo/src/b/f'))
+    # In worktree mode, sparsity is per worktree, not in the shared config of the central repo.
+    opts = dict(worktrees=os.path.join(tmp, 'central'))
+    for ws in ('ws1', 'ws2'):
+        os.mkdir(os.path.join(tmp, ws))
+    with cmds.cd(os.path.join(tmp, 'ws1')):
+        cmds.checkout_repo(dict(conf, sparse='docs'), '', opts)
+        nt.assert_equal(['docs'], cmds.get_sparse_state('foo'))
+    with cmds.cd(os.path.join(tmp, 'ws2')):
+        cmds.checkout_repo(conf, '', opts)
+        nt.assert_equal(None, cmds.get_sparse_state('foo'))
+        nt.assert_true(os.path.exists('foo/src/b/f'))
+    central, = [os.path.join(opts['worktrees'], fn) for fn in os.listdir(opts['worktrees']) if fn.endswith('.git')]
+    config = cmds.capture('git config --file {} --list'.format(os.path.join(central, 'config')))[0]
+    nt.assert_false('sparse' in config.lower())
+    nt.assert_equal('true', cmds.capture('git --git-dir={} rev-parse --is-bare-repository'.format(central))[0].strip())
+
+def test_maintain():
+    from pb_git import maintain
+    base = tempfile.mkdtemp()
+    tree = fixtures.make_tree(base, nrepos=2, nfiles=2, ncommits=3)
+    ws = tree['workspace']
+    repos = tree['repos']
+    with cmds.cd(ws):
+        for name in ('repo000', 'repo001'):
+            cmds.checkout_repo(repos[name], '')
+        cmds.system('cd repo000 && for i in 1 2 3; do echo $i > loose$i && git add loose$i && {} git commit -qm $i; done'.format(git_env))
+        targets = maintain.get_targets(repos)
+        nt.assert_equal(['repo000', 'repo001'], [t['path'] for t in targets])
+        # Below the thresholds, the cheap mode does nothing.
+        nt.assert_equal([None, None], [r for _, r in maintain.run_targets(targets, maintain.AUTO_TASKS, 2, auto=True)])
+        results = maintain.run_targets(targets, maintain.FULL_TASKS, jobs=2)
+        gitdir = targets[0]['gitdir']
+        nt.assert_equal(0, maintain.count_objects(gitdir)['count'])
+        nt.assert_true(os.path.exists(os.path.join(gitdir, 'objects', 'info', 'commit-graphs')))
+        nt.assert_true(os.path.exists(os.path.join(gitdir, 'objects', 'pack', 'multi-pack-index')))
+        nt.assert_true(results[0][1]['probe_after'] is not None)
+        nt.assert_equal(4, len(maintain.format_results(results).splitlines()))
+    # A remote mirror tree is never resolved nor maintained.
+    args = argparse.Namespace(directory=ws, inis=None, verbosity=0, trace=None, mirrors='host:/mirrors', jobs=2, auto=False)
+    with fixtures.isolated() as out:
+        maintain.maintain(args)
+    nt.assert_equal(['repo000', 'repo001'], [line.split()[-1] for line in out.getvalue().splitlines()[1:-1]])